@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+"""
+Micro-benchmarks of the hot pure functions, with regression gates.
+
+    bench.py [NAME ...] [--repeat N] [--sample-time S] [--tolerance F]
+             [--baseline PATH] [--save]
+
+Every benchmark builds a synthetic fixture once and then times single
+calls: each of `--repeat` samples runs enough calls to take
+`--sample-time` seconds with the GC off, and the median and p95 time per
+call are reported. Allocations are measured separately with tracemalloc:
+the peak bytes one call allocates and the bytes a call leaves behind.
+NAMEs select the benchmarks whose name contains one of them.
+
+Results are checked against `bench_baseline.json`. A benchmark regresses
+when its median exceeds the baseline by more than `--tolerance` (25% by
+default) or it allocates more than that above the baseline, and the exit
+status is then 1. Every baseline entry keeps the median of a fixed
+calibration loop on the machine it was saved on and timings are scaled by
+it, so a baseline saved elsewhere still roughly applies. `--save` writes
+this run's results into the baseline. Benchmarks bound by I/O rather
+than CPU register a wider tolerance of their own, the larger of the two
+applies.
+"""
+
+import argparse
+import atexit
+import contextlib
+import gc
+import importlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import msgpack
+
+import event_codec
+import fleet_sim
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+REPEAT = 25
+SAMPLE_TIME = 0.01
+TOLERANCE = 0.25
+ALLOC_CALLS = 50
+ALLOC_SLACK = 256
+
+BENCHMARKS = {}
+TOLERANCES = {}
+FIXTURES = {}
+
+
+def benchmark(name: str, tolerance: float = None):
+    """
+    Registers a fixture builder returning the zero-argument call to time
+    """
+    def register(setup):
+        BENCHMARKS[name] = setup
+        if tolerance is not None:
+            TOLERANCES[name] = tolerance
+        return setup
+    return register
+
+
+def workdir() -> str:
+    if "workdir" not in FIXTURES:
+        FIXTURES["workdir"] = tempfile.mkdtemp(prefix="bench-")
+        atexit.register(shutil.rmtree, FIXTURES["workdir"], True)
+    return FIXTURES["workdir"]
+
+
+def handlerFixture(name: str = "state"):
+    """
+    A display handler on an emulated panel, as fleet_sim runs it
+    """
+    if name not in FIXTURES:
+        module = fleet_sim.loadHandlerModule(name, os.path.join(workdir(), f"push-{name}"), workdir())
+        household = fleet_sim.Household(0, "declaration", 1, random.Random(0))
+        household.members = [chr(65+i) for i in range(8)]
+        fleet_sim.CURRENT.household = household
+        with contextlib.redirect_stdout(io.StringIO()):
+            FIXTURES[name] = module.SimHandler(household)
+    return FIXTURES[name]
+
+
+def rc5Codes(handler) -> list:
+    """
+    Panel codes for every remote key with the toggle bit flipping, so each
+    one reads as a new press
+    """
+    codes = []
+    for toggle, cmd in enumerate(sorted(handler.NumToKey)):
+        codes.append(0xC003 | (toggle & 1) << 13 | cmd << 2)
+    return codes
+
+
+def declaredMasks(handler, count: int = 64) -> list:
+    rng = random.Random(1)
+    return [rng.getrandbits(17) & handler.registeredMask for _ in range(count)]
+
+
+@benchmark("state.parseRC5PlusCode")
+def parseRC5():
+    handler = handlerFixture()
+    codes = itertools.cycle(rc5Codes(handler))
+    return lambda: handler.parseRC5PlusCode(next(codes))
+
+
+@benchmark("state.detectKeypress")
+def detectKeypress():
+    handler = handlerFixture()
+    codes = itertools.cycle(rc5Codes(handler))
+    panel = types.SimpleNamespace(ReadRemoteCmd=lambda: next(codes))
+    return lambda: handler.detectKeypress(panel)
+
+
+@benchmark("state.buildViewershipRows")
+def buildViewershipRows():
+    handler = handlerFixture()
+    masks = itertools.cycle(declaredMasks(handler))
+
+    def call():
+        handler.declaredMask = next(masks)
+        handler.buildViewershipRows()
+    return call
+
+
+@benchmark("state.display")
+def display():
+    handler = handlerFixture()
+    masks = itertools.cycle(declaredMasks(handler))
+
+    def call():
+        handler.declaredMask = next(masks)
+        handler.display()
+    return call
+
+
+@benchmark("state.pushEvent")
+def pushEvent():
+    handler = handlerFixture()
+    handler.sendEvent = lambda body: None
+    masks = itertools.cycle(declaredMasks(handler))
+
+    def call():
+        handler.declaredMask = next(masks)
+        handler.pushEvent()
+    return call
+
+
+def bmpFixture(width: int = 256, height: int = 64) -> bytes:
+    """
+    An 8 bit, 16 colour palette BMP like the one Pillow makes for the F002
+    """
+    rng = random.Random(2)
+    palette = b"".join(bytes((i * 17, i * 17, i * 17, 0)) for i in range(16))
+    offset = 54 + len(palette)
+    pixels = bytes(rng.randrange(16) for _ in range(width * height))
+    header = struct.pack("<2sIHHI", b"BM", offset + len(pixels), 0, 0, offset)
+    info = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 8, 0, len(pixels), 2835, 2835, 16, 16)
+    return header + info + palette + pixels
+
+
+class FakeSerial():
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+
+def driverModule():
+    """
+    The real display driver module, the handler fixtures leave a
+    placeholder for it in sys.modules
+    """
+    placeholder = sys.modules.pop("display", None)
+    try:
+        return importlib.import_module("display")
+    finally:
+        if placeholder is not None:
+            sys.modules["display"] = placeholder
+
+
+@benchmark("display.bmp_to_arraybyte")
+def bmpToArraybyte():
+    display = driverModule()
+    bmp = bmpFixture()
+    return lambda: display.DisplayF002.bmp_to_arraybyte(None, bmp)
+
+
+@benchmark("display.DisplayF003.Send")
+def f003Send():
+    display = driverModule()
+    # The panel paces every LED write with a sleep, only the diffing is timed
+    display.time = types.SimpleNamespace(sleep=lambda seconds: None, monotonic=time.monotonic)
+    with contextlib.redirect_stdout(io.StringIO()):
+        panel = display.DisplayF003(FakeSerial(), 0x2047, 0xf003)
+    rng = random.Random(3)
+    frames = itertools.cycle([
+        ("".join(chr(65+i) if rng.random() < 0.5 else "_" for i in range(12)),
+         "".join(str(i+1) if rng.random() < 0.3 else "_" for i in range(5)) + rng.choice("01"))
+        for _ in range(32)
+    ])
+    return lambda: panel.Send(*next(frames))
+
+
+def encodePlmn(mcc: int, mnc: int, three_digit: bool) -> str:
+    mcc, mnc = f"{mcc:03d}", f"{mnc:03d}" if three_digit else f"{mnc:02d}"
+    return mcc[1] + mcc[0] + (mnc[2] if three_digit else "f") + mcc[2] + mnc[1] + mnc[0]
+
+
+def cellFixture(count: int = 30) -> list:
+    rng = random.Random(4)
+    cells = []
+    for _ in range(count):
+        if cells and rng.random() < 0.3:
+            cell = dict(rng.choice(cells), Sig_Str=rng.randrange(40, 100))
+        else:
+            cell = {"MCC": 404, "MNC": rng.randrange(100), "LAC": rng.randrange(1 << 16), "CID": rng.randrange(1 << 28),
+                    "Sig_Str": rng.randrange(40, 100), "Band": rng.choice(("GSM", "WCDMA")), "GPRS": False}
+        cells.append(cell)
+    return cells
+
+
+@benchmark("cellinfo.decodePlmn x20")
+def decodePlmn():
+    import cellinfo_hl8518
+    rng = random.Random(5)
+    plmns = [encodePlmn(404, rng.randrange(100), rng.random() < 0.3) for _ in range(20)]
+    known = tuple(str(p) for p in range(0, 1000, 7))
+
+    def call():
+        for plmn in plmns:
+            cellinfo_hl8518.decodePlmn(plmn, known)
+    return call
+
+
+@benchmark("cellinfo.dedupCellInfos x30")
+def dedupCellInfos():
+    import cellinfo_hl8518
+    cells = cellFixture()
+    return lambda: cellinfo_hl8518.dedupCellInfos(cells)
+
+
+# one call is a few temp file roundtrips, its timing follows the disk
+def eventsDbFixture():
+    """
+    An in-memory events.db with 20 events of each of the 41 types
+    """
+    if "events_db" not in FIXTURES:
+        rng = random.Random(6)
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE events (boot_seq INTEGER, event_id INTEGER, event_type INTEGER, "
+                     "uptime_sec INTEGER, uptime_nsec INTEGER, body BLOB)")
+        rows = []
+        for event_id in range(41 * 20):
+            event_type = event_id % 41 + 1
+            if event_type == event_codec.EVENT_TYPE_MEM_GUEST_DECL:
+                body = event_codec.declarationEvent(rng.getrandbits(12), rng.getrandbits(5))
+            else:
+                body = msgpack.packb(1) + msgpack.packb(event_type) + msgpack.packb({"Value": rng.random(), "Count": event_id})
+            rows.append((1, event_id, event_type, event_id, 0, body))
+        conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", rows)
+        FIXTURES["events_db"] = conn
+    return FIXTURES["events_db"]
+
+
+@benchmark("events_db.readEvents")
+def eventsDbDecode():
+    import db_event_JSON_parser
+    conn = eventsDbFixture()
+    event_types = itertools.cycle(range(1, 42))
+    return lambda: list(db_event_JSON_parser.readEvents(conn, next(event_types)))
+
+
+@benchmark("events_db.export 820 events")
+def eventsDbExport():
+    import db_event_JSON_parser
+    conn = eventsDbFixture()
+    out = types.SimpleNamespace(write=len)
+    return lambda: db_event_JSON_parser.exportEvents(conn, out)
+
+
+def calibration():
+    total = 0
+    for i in range(1000):
+        total += i * i
+    return total
+
+
+def timeCalls(func, calls: int) -> float:
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        return time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def measure(func, repeat: int = REPEAT, sample_time: float = SAMPLE_TIME) -> dict:
+    """
+    Returns the per call median and p95 in microseconds and the calls per
+    sample
+    """
+    calls = 1
+    for multiplier in itertools.cycle((2, 2.5, 2)):
+        if timeCalls(func, calls) >= sample_time:
+            break
+        calls = int(calls * multiplier)
+    samples = sorted(timeCalls(func, calls) / calls * 1e6 for _ in range(repeat))
+    return {"calls": calls, "median_us": statistics.median(samples), "p95_us": fleet_sim.percentile(samples, 0.95)}
+
+
+def allocations(func, calls: int = ALLOC_CALLS) -> dict:
+    """
+    Returns the peak bytes a call allocates and the bytes a call keeps
+    """
+    func()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        peak = 0
+        for _ in range(calls):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        kept = (tracemalloc.get_traced_memory()[0] - base) / calls
+    finally:
+        tracemalloc.stop()
+    return {"alloc_bytes": peak, "kept_bytes": max(kept, 0)}
+
+
+def check(result: dict, base: dict, tolerance: float):
+    """
+    Returns the scaled baseline median and whether `result` regressed
+    """
+    if base is None:
+        return None, False
+    expected = base["median_us"] * result["calibration_us"] / base["calibration_us"]
+    slower = result["median_us"] > expected * (1 + tolerance)
+    bigger = result["alloc_bytes"] > base["alloc_bytes"] * (1 + tolerance) + ALLOC_SLACK
+    return expected, slower or bigger
+
+
+def loadBaseline(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the hot functions with regression gates")
+    parser.add_argument("names", nargs="*", help="run the benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--sample-time", type=float, default=SAMPLE_TIME, help="seconds per sample")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed regression, 0.25 for 25%%")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store this run as the baseline")
+    args = parser.parse_args()
+
+    baseline = loadBaseline(args.baseline)
+    calibration_us = measure(calibration, args.repeat, args.sample_time)["median_us"]
+    print(f"{'benchmark':<30} {'calls':>7} {'median us':>10} {'p95 us':>10} {'alloc B':>9} {'kept B':>8} {'base us':>10} {'change':>8}  status")
+    regressed = []
+    for name, setup in BENCHMARKS.items():
+        if args.names and not any(n in name for n in args.names):
+            continue
+        try:
+            func = setup()
+        except ImportError as e:
+            print(f"{name:<30} {'':>7} {'':>10} {'':>10} {'':>9} {'':>8} {'':>10} {'':>8}  skipped: {e}")
+            continue
+        result = measure(func, args.repeat, args.sample_time)
+        result.update(allocations(func, min(ALLOC_CALLS, result["calls"])), calibration_us=calibration_us)
+        expected, failed = check(result, baseline.get(name), max(args.tolerance, TOLERANCES.get(name, 0)))
+        if expected is None:
+            change, status = "", "new"
+        else:
+            change, status = f"{(result['median_us'] / expected - 1) * 100:+.1f}%", "REGRESSED" if failed else "ok"
+            expected = f"{expected:.2f}"
+        print(f"{name:<30} {result['calls']:>7} {result['median_us']:>10.2f} {result['p95_us']:>10.2f} "
+              f"{result['alloc_bytes']:>9} {result['kept_bytes']:>8.0f} {expected or '':>10} {change:>8}  {status}")
+        if failed:
+            regressed.append(name)
+        if args.save:
+            baseline[name] = {k: result[k] for k in ("median_us", "p95_us", "alloc_bytes", "calibration_us")}
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"Saved the baseline to {args.baseline}")
+    elif regressed:
+        print(f"{len(regressed)} benchmark(s) regressed beyond their tolerance: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
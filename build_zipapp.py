@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""
+Builds the display handler as a zipapp of precompiled modules.
+
+    build_zipapp.py [--main state|state_dual] [--output PATH] [--source DIR]
+
+The modules the handler imports from `--source` (this directory by
+default) are found with modulefinder, lazy imports inside functions
+included, compiled to `.pyc` and zipped with their sources into an
+executable archive that runs `<main>.main()`. The `.pyc` files are
+unchecked-hash ones, so the interpreter loads them without comparing
+them against the sources, which are only there for tracebacks.
+
+Third-party packages (msgpack, pyserial, Pillow, ...) are not bundled and
+are imported from the system as before. Handler modules imported from
+`--source` but not found there, like `db` where it is installed
+separately, are listed and must be importable on the target. The fonts
+are still read relative to the working directory.
+
+Run the archive like the script, `python3 display-handler.pyz`, with the
+same environment; `startup_report.py --pyz` times its startup.
+"""
+
+import argparse
+import modulefinder
+import os
+import py_compile
+import sys
+import tempfile
+import zipapp
+
+INTERPRETER = "/usr/bin/env python3"
+
+
+def handlerModules(source: str, main: str):
+    """
+    Returns the modules under `source` that `main` imports, as
+    {name: path}, and the names they import that could not be found
+    """
+    source = os.path.abspath(source)
+    finder = modulefinder.ModuleFinder(path=[source] + sys.path[1:])
+    finder.run_script(os.path.join(source, main + ".py"))
+    modules = {}
+    for name, module in finder.modules.items():
+        path = module.__file__
+        if name == "__main__" or not path or os.path.dirname(os.path.abspath(path)) != source:
+            continue
+        modules[name] = path
+    modules[main] = os.path.join(source, main + ".py")
+    missing = sorted(name for name, importers in finder.badmodules.items()
+                     if "." not in name and ("__main__" in importers or set(importers) & set(modules)))
+    return modules, missing
+
+
+def build(source: str, main: str, output: str) -> dict:
+    modules, missing = handlerModules(source, main)
+    with tempfile.TemporaryDirectory(prefix="zipapp-") as staging:
+        with open(os.path.join(staging, "__main__.py"), "w") as f:
+            f.write(f"import {main}\n{main}.main()\n")
+        for name, path in sorted(modules.items()) + [("__main__", os.path.join(staging, "__main__.py"))]:
+            target = os.path.join(staging, name + ".py")
+            if path != target:
+                with open(path, "rb") as src, open(target, "wb") as dst:
+                    dst.write(src.read())
+            py_compile.compile(target, cfile=os.path.join(staging, name + ".pyc"), dfile=name + ".py",
+                               doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        zipapp.create_archive(staging, output, interpreter=INTERPRETER, compressed=True)
+    return {"modules": sorted(modules), "missing": missing, "size": os.path.getsize(output)}
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Build the display handler as a precompiled zipapp")
+    parser.add_argument("--main", default="state", help="handler module, state or state_dual")
+    parser.add_argument("--output", default="display-handler.pyz")
+    parser.add_argument("--source", default=here, help="directory of the handler modules")
+    args = parser.parse_args()
+
+    result = build(args.source, args.main, args.output)
+    print(f"Wrote {args.output} ({result['size']} bytes): {', '.join(result['modules'])}")
+    if result["missing"]:
+        print(f"Not bundled, must be importable on the target: {', '.join(result['missing'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Single entry point for the external commands the display handler runs.
+
+`getoutput`, `call` and `run` behave like their `subprocess` namesakes and
+account every spawn under a command name (by default the first two words
+of the command line): count, cumulative and max wall time and exit
+statuses. Each spawn is also a span for `trace_spans`.
+
+Set `DISPLAY_HANDLER_SPAWN_WARN_RATE` to print a warning whenever one
+command is spawned more than that many times within a second.
+"""
+
+import os
+import subprocess
+import time
+
+from trace_spans import tracer
+
+SPAWN_WARN_RATE = float(os.environ.get("DISPLAY_HANDLER_SPAWN_WARN_RATE", 0))
+
+
+def commandName(cmd) -> str:
+    if isinstance(cmd, (list, tuple)):
+        words = [os.path.basename(str(cmd[0]))] + [str(c) for c in cmd[1:2]] if cmd else []
+    else:
+        words = str(cmd).split()[:2]
+    return " ".join(words)
+
+
+class CommandStats():
+
+    __slots__ = ("count", "total", "max", "statuses", "window", "window_count")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.statuses = {}
+        self.window = 0
+        self.window_count = 0
+
+
+class Commands():
+
+    def __init__(self, warn_rate: float = SPAWN_WARN_RATE):
+        self.warn_rate = warn_rate
+        self.stats = {}
+
+
+    def record(self, name: str, start: float, end: float, status):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = CommandStats()
+        elapsed = end - start
+        stats.count += 1
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if self.warn_rate:
+            window = int(end)
+            if window != stats.window:
+                stats.window = window
+                stats.window_count = 0
+            stats.window_count += 1
+            if stats.window_count == int(self.warn_rate) + 1:
+                print(f"'{name}' spawned more than {self.warn_rate:g} times in a second")
+        tracer.complete(name, start, end, "command", {"status": status})
+
+
+    def getoutput(self, cmd, name: str = None) -> str:
+        start = time.monotonic()
+        status = None
+        try:
+            status, output = subprocess.getstatusoutput(cmd)
+        finally:
+            self.record(name or commandName(cmd), start, time.monotonic(), status)
+        return output
+
+
+    def call(self, cmd, name: str = None, **kwargs) -> int:
+        start = time.monotonic()
+        status = None
+        try:
+            status = subprocess.call(cmd, **kwargs)
+        finally:
+            self.record(name or commandName(cmd), start, time.monotonic(), status)
+        return status
+
+
+    def run(self, cmd, name: str = None, **kwargs) -> subprocess.CompletedProcess:
+        start = time.monotonic()
+        status = None
+        try:
+            result = subprocess.run(cmd, **kwargs)
+            status = result.returncode
+        finally:
+            self.record(name or commandName(cmd), start, time.monotonic(), status)
+        return result
+
+
+    def report(self) -> str:
+        lines = []
+        for name, s in sorted(self.stats.items(), key=lambda item: -item[1].total):
+            statuses = " ".join(f"{k}:{v}" for k, v in s.statuses.items())
+            lines.append(f"{name:<28} n={s.count:<7} total={s.total:.2f}s max={s.max * 1000:.1f}ms exit {statuses}")
+        return "\n".join(lines)
+
+
+commands = Commands()
+getoutput = commands.getoutput
+call = commands.call
+run = commands.run
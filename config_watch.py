@@ -0,0 +1,62 @@
+"""
+inotify based watch on a single config file.
+
+The parent directory is watched so that files replaced by rename (the way
+most config writers update them) are picked up as well as in-place writes.
+Only completed writes count: creating the file is not an event, as it is
+still empty then.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_EVENT = struct.Struct("iIII")
+
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+class FileWatch():
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path).encode()
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(path)).encode()
+        if libc.inotify_add_watch(self.fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def changed(self) -> bool:
+        """
+        Drains the pending events without blocking, True if any of them
+        touched the watched file.
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = IN_EVENT.unpack_from(data, offset)
+                offset += IN_EVENT.size
+                if data[offset:offset+length].rstrip(b"\0") == self.name:
+                    changed = True
+                offset += length
+
+
+    def close(self):
+        os.close(self.fd)
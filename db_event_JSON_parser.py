@@ -1,10 +1,42 @@
 #!/usr/bin/python
+"""
+Prints or exports the events stored in events.db.
+
+    db_event_JSON_parser.py [DB] [--export OUT] [--types 1-5,25] [--boots 7,8]
+                            [--limit N] [--index COPY] [--explain]
+
+Without `--export` the first 3 events of each of the 41 event types are
+printed. With it every event is written to OUT (`-` for stdout) as one
+JSON object per line:
+
+    {"boot_seq": 3, "event_id": 1201, "event_type": 25, "uptime_sec": 8412,
+     "uptime_nsec": 120443000, "body": [1, 25, {"Lock": false, ...}]}
+
+`body` holds the msgpack objects the event body is made of, binary data
+as {"bin": "<hex>"}. An event whose body does not decode completely gets
+an "error" next to the objects that did. Rows are streamed from the
+database, opened read only, and all bodies go through one Unpacker, so
+memory use does not grow with the size of the database.
+
+`--types` and `--boots` select event types and boot sequences, `--limit`
+caps the events per type. The queries are parameterized. An index whose
+first column is event_type makes every type with a limit one index seek;
+without one, all types are read in a single scan of the table.
+`--index COPY` copies the database to COPY, adds a covering
+`(event_type, boot_seq, event_id)` index there and queries the copy, the
+original is left untouched. The copy records the size and mtime of the
+database it came from and is made again once those change. `--explain` prints the query plans to stderr.
+"""
 
 #use requirements.txt to install these dependancies
 #Environment details are mentioned in file, environment.md
 
+import argparse
+import json
+from pathlib import Path
 #SQLite version 0.0.1
 import sqlite3
+import sys
 
 #msgpack version 1.0.0
 import msgpack
@@ -16,40 +48,314 @@ def dprint(debugMsg):
         print(debugMsg)
 
 
-#add DB filename in the bracket. Assumes the file to be present in the working directory
-conn = sqlite3.connect('/var/data/events.db')
-dprint("Opened database successfully\n")
+DB_PATH = '/var/data/events.db'
+EVENT_COLUMNS = "boot_seq, event_id, event_type, uptime_sec, uptime_nsec, body"
+EVENT_TYPES = range(1, 42)
+PRINT_LIMIT = 3
+TYPE_INDEX = "events_type_boot_id"
+TYPE_INDEX_SQL = f"CREATE INDEX IF NOT EXISTS {TYPE_INDEX} ON events (event_type, boot_seq, event_id)"
+COPY_STAMP_TABLE = "indexed_copy_source"
+
+
+class BodyDecoder():
+    """
+    Decodes event bodies by feeding them in turn to one Unpacker
+    """
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.unpacker = msgpack.Unpacker(raw=False, strict_map_key=False, unicode_errors="surrogateescape")
+        self.fed = 0
+
+
+    def decode(self, body):
+        """
+        Returns the msgpack objects `body` is made of and an error, None if
+        it decoded completely
+        """
+        if body is None:
+            return [], "no body"
+        self.unpacker.feed(body)
+        self.fed += len(body)
+        objects = []
+        try:
+            for obj in self.unpacker:
+                objects.append(obj)
+        except (ValueError, TypeError) as e:
+            self.reset()
+            return objects, f"malformed body: {e or type(e).__name__}"
+        if self.unpacker.tell() != self.fed:
+            # the rest of a truncated object must not run into the next body
+            self.reset()
+            return objects, "truncated body"
+        return objects, None
+
+
+decoder = BodyDecoder()
+
+
+def decodeBody(body):
+    """
+    Returns the msgpack objects an event body is made of
+    """
+    objects, error = decoder.decode(body)
+    return objects
+
+
+def filterConditions(types=None, boots=None):
+    """
+    Returns the conditions selecting `types` and `boots` and their
+    parameters
+    """
+    conditions = []
+    params = []
+    for column, values in (("event_type", types), ("boot_seq", boots)):
+        if values is not None:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    return conditions, params
+
+
+def explain(conn, sql, params):
+    print(f"QUERY PLAN {sql}", file=sys.stderr)
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+        print(f"  {row[-1]}", file=sys.stderr)
+
+
+def hasTypeIndex(conn):
+    for index in conn.execute("PRAGMA index_list(events)").fetchall():
+        columns = conn.execute(f"PRAGMA index_info({index[1]!r})").fetchall()
+        if columns and min(columns)[2] == "event_type":
+            return True
+    return False
+
 
-for event_type in range(1,42):
-    print("\n\n****************************************************************************")
-    print("Current event type: ", event_type)
-    print("****************************************************************************")
+def selectEvents(conn, types=None, boots=None, limit=None, show_plan=False):
+    """
+    Yields the rows of the events of `types` (all if None) in `boots`, at
+    most `limit` per type. With a limit and an event_type index every type
+    is one seek and the rows come grouped by type, otherwise the table is
+    read once in storage order.
+    """
+    indexed = limit is not None and hasTypeIndex(conn)
+    if indexed or (limit is not None and types is not None and len(types) == 1):
+        if types is None:
+            types = [row[0] for row in conn.execute("SELECT DISTINCT event_type FROM events ORDER BY event_type")]
+        conditions, params = filterConditions(None, boots)
+        where = " AND ".join(["event_type = ?"] + conditions)
+        # without the index the order would cost a sort of the whole type
+        order = " ORDER BY boot_seq, event_id" if indexed else ""
+        sql = f"SELECT {EVENT_COLUMNS} FROM events WHERE {where}{order} LIMIT ?"
+        if show_plan:
+            explain(conn, sql, [0] + params + [limit])
+        for event_type in types:
+            # the same statement text reuses the prepared statement
+            yield from conn.execute(sql, [event_type] + params + [limit])
+        return
 
-    #[WIP remove unecessary columns for the sake of execution speed]
-    cursor = conn.execute(f"SELECT boot_seq, event_id, event_type, uptime_sec, uptime_nsec, body FROM events WHERE event_type = {event_type} LIMIT 3")
+    conditions, params = filterConditions(types, boots)
+    sql = f"SELECT {EVENT_COLUMNS} FROM events"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if limit is None:
+        if show_plan:
+            explain(conn, sql, params)
+        yield from conn.execute(sql, params)
+        return
+    # the scan only reads the types, the kept rows are fetched by rowid
+    scan = sql.replace(EVENT_COLUMNS, "rowid, event_type", 1)
+    fetch = f"SELECT {EVENT_COLUMNS} FROM events WHERE rowid = ?"
+    if show_plan:
+        explain(conn, scan, params)
+        explain(conn, fetch, [0])
+    counts = {}
+    remaining = len(types) if types is not None else None
+    for rowid, event_type in conn.execute(scan, params):
+        count = counts.get(event_type, 0)
+        if count >= limit:
+            continue
+        counts[event_type] = count + 1
+        yield conn.execute(fetch, (rowid,)).fetchone()
+        if remaining is not None and count + 1 == limit:
+            remaining -= 1
+            if not remaining:
+                break
 
-    for row in cursor:
-        # print("----------------------------------------------------------------------------")
-        # print("ID = ", row[1])
-        # print("Type = ", row[2])
 
-        # writes data to file, this is later read by the Unpacker 
-        # To-DO: inefficient method, change it. Currently implemented because the Unpacker needs
-        # object with read() method support.
-        with open("data.msgpack", "wb") as dataFile:
-            dataFile.write(row[5])
+def readEvents(conn, event_type, limit=PRINT_LIMIT):
+    """
+    Yields the decoded bodies of the first `limit` events of a type
+    """
+    for row in selectEvents(conn, [event_type], limit=limit):
+        yield decodeBody(row[5])
 
-        #unpacks the multiple msgpack objects and returns a list of them
-        with open("data.msgpack", "rb") as file:
-            unp = msgpack.Unpacker(file)
 
-            for data in unp:
+def openDatabase(path):
+    """
+    Opens the database read only, copies pulled from meters are never
+    written to
+    """
+    return sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+
+
+def sourceStamp(path):
+    """
+    Identifies the current contents of the database at `path` by the
+    path, size and mtime of it and of its WAL
+    """
+    parts = [str(Path(path).resolve())]
+    for name in (path, path + "-wal"):
+        try:
+            st = Path(name).stat()
+        except FileNotFoundError:
+            continue
+        parts.append(f"{st.st_size}:{st.st_mtime_ns}")
+    return " ".join(parts)
+
+
+def copyStamp(copy):
+    """
+    Returns the source stamp recorded in an indexed copy, None if `copy`
+    was not made by indexedCopy
+    """
+    try:
+        conn = openDatabase(copy)
+        try:
+            return conn.execute(f"SELECT stamp FROM {COPY_STAMP_TABLE}").fetchone()[0]
+        finally:
+            conn.close()
+    except (sqlite3.Error, TypeError):
+        return None
+
+
+def indexedCopy(path, copy):
+    """
+    Copies the database to `copy` and adds the event_type index there,
+    returns the copy opened read only. An existing copy is reused only if
+    it was made from the current contents of `path`, a stale one is made
+    again and a file that is not such a copy is refused.
+    """
+    stamp = sourceStamp(path)
+    if Path(copy).exists():
+        if Path(copy).resolve() == Path(path).resolve():
+            sys.exit(f"{copy} is the database itself, the indexed copy needs a path of its own")
+        copied = copyStamp(copy)
+        if copied is None:
+            sys.exit(f"{copy} exists and is not an indexed copy, refusing to replace it")
+        if copied == stamp:
+            return openDatabase(copy)
+        print(f"{copy} was copied from an older or another database, copying {path} again", file=sys.stderr)
+    source = openDatabase(path)
+    target = sqlite3.connect(copy + ".tmp")
+    source.backup(target)
+    source.close()
+    target.execute(TYPE_INDEX_SQL)
+    target.execute(f"DROP TABLE IF EXISTS {COPY_STAMP_TABLE}")
+    target.execute(f"CREATE TABLE {COPY_STAMP_TABLE} (stamp TEXT)")
+    target.execute(f"INSERT INTO {COPY_STAMP_TABLE} VALUES (?)", (stamp,))
+    target.commit()
+    target.close()
+    Path(copy + ".tmp").replace(copy)
+    return openDatabase(copy)
+
+
+def jsonDefault(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {"bin": bytes(obj).hex()}
+    if isinstance(obj, msgpack.ExtType):
+        return {"ext": obj.code, "bin": obj.data.hex()}
+    if isinstance(obj, msgpack.Timestamp):
+        return obj.to_unix()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def exportEvents(conn, out, types=None, boots=None, limit=None, show_plan=False):
+    """
+    Writes the selected events as JSON lines to `out`, returns the number
+    of events and of those that did not decode
+    """
+    body_decoder = BodyDecoder()
+    count = errors = 0
+    for boot_seq, event_id, event_type, uptime_sec, uptime_nsec, body in selectEvents(conn, types, boots, limit, show_plan):
+        objects, error = body_decoder.decode(body)
+        record = {"boot_seq": boot_seq, "event_id": event_id, "event_type": event_type,
+                  "uptime_sec": uptime_sec, "uptime_nsec": uptime_nsec, "body": objects}
+        if error:
+            record["error"] = error
+            errors += 1
+        out.write(json.dumps(record, default=jsonDefault, separators=(",", ":")))
+        out.write("\n")
+        count += 1
+    return count, errors
+
+
+def export(conn, path, **filters):
+    if path == "-":
+        count, errors = exportEvents(conn, sys.stdout, **filters)
+    else:
+        with open(path, "w") as out:
+            count, errors = exportEvents(conn, out, **filters)
+    print(f"Exported {count} events, {errors} did not decode", file=sys.stderr)
+
+
+def intSet(text):
+    """
+    Parses "1-5,25" into [1, 2, 3, 4, 5, 25]
+    """
+    values = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        try:
+            values.extend(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"not a number or range: {part!r}")
+    return sorted(set(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print or export the events in events.db")
+    parser.add_argument("db", nargs="?", default=DB_PATH)
+    parser.add_argument("--export", metavar="OUT", help="write every event as JSON Lines to OUT, - for stdout")
+    parser.add_argument("--types", type=intSet, help="event types, e.g. 1-5,25")
+    parser.add_argument("--boots", type=intSet, help="boot sequences, e.g. 7,8")
+    parser.add_argument("--limit", type=int, help=f"events per type, {PRINT_LIMIT} when printing and all when exporting by default")
+    parser.add_argument("--index", metavar="COPY", help="query an indexed copy of the database at COPY, made again when the database changed")
+    parser.add_argument("--explain", action="store_true", help="print the query plans to stderr")
+    args = parser.parse_args()
+
+    conn = indexedCopy(args.db, args.index) if args.index else openDatabase(args.db)
+    dprint("Opened database successfully\n")
+
+    if args.export:
+        export(conn, args.export, types=args.types, boots=args.boots, limit=args.limit, show_plan=args.explain)
+        conn.close()
+        return
+
+    types = args.types or EVENT_TYPES
+    limit = args.limit if args.limit is not None else PRINT_LIMIT
+    # grouped by type, the single scan returns them in storage order
+    events = dict((event_type, []) for event_type in types)
+    for row in selectEvents(conn, list(types), args.boots, limit, args.explain):
+        events[row[2]].append(decodeBody(row[5]))
+
+    for event_type in types:
+        print("\n\n****************************************************************************")
+        print("Current event type: ", event_type)
+        print("****************************************************************************")
+
+        for objects in events[event_type]:
+            for data in objects:
                 print(data)
                 print("----------------------------------------------------------------------------")
-        
-#            print("\n")
 
-dprint("\n\nOperation done successfully")
+    dprint("\n\nOperation done successfully")
+
+    #Do not forget this!
+    conn.close()
+
 
-#Do not forget this!
-conn.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Emits the DisplayHandler `StateChange` D-Bus signal over a persistent bus
+connection instead of forking `dbus-send` for every state save.
+
+The signal carries no arguments, so the signals raised while the bus is
+unreachable coalesce into one that a background thread sends once it
+reconnects. The thread connects without holding the lock, `notify()`
+never waits for the bus. Set `DISPLAY_HANDLER_DBUS_BUS` to a
+bus address (e.g. the one printed by `dbus-daemon --session --print-address`)
+to point the notifier at a private bus.
+"""
+
+import commands
+import os
+import threading
+import time
+
+try:
+    from jeepney import DBusAddress, new_signal
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+DBUS_OBJECT_PATH = "/in/fluctus/baro3/DisplayHandler"
+DBUS_INTERFACE = "in.fluctus.baro3.DisplayHandler"
+DBUS_SIGNAL = "StateChange"
+DBUS_SEND_CMD = f"dbus-send --system {DBUS_OBJECT_PATH} {DBUS_INTERFACE}.{DBUS_SIGNAL}"
+RECONNECT_INTERVAL = 5
+
+
+class StateChangeNotifier():
+
+    def __init__(self, bus=None):
+        self.bus = bus or os.environ.get("DISPLAY_HANDLER_DBUS_BUS", "SYSTEM")
+        self.conn = None
+        self.pending = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.sent = 0
+        self.failures = 0
+        self.reconnects = 0
+        if open_dbus_connection is None:
+            print("jeepney not available, falling back to dbus-send")
+            return
+        self.signal = new_signal(DBusAddress(DBUS_OBJECT_PATH, interface=DBUS_INTERFACE), DBUS_SIGNAL)
+        self.thread = threading.Thread(target=self.reconnectLoop, name="dbus-notify", daemon=True)
+        self.thread.start()
+        # Connect in the background so that startup is not held up by the bus
+        self.wakeup.set()
+
+
+    def notify(self):
+        """
+        Emits `StateChange`, leaving it pending if the bus is down
+        """
+        if open_dbus_connection is None:
+            commands.call(DBUS_SEND_CMD, name="dbus-send", shell=True)
+            return
+        with self.lock:
+            self.pending = True
+            if self.conn is not None:
+                self.flush()
+            queued = self.pending
+        if queued:
+            self.wakeup.set()
+
+
+    def flush(self):
+        """
+        Sends the pending signal, must be called with `lock` held
+        """
+        if not self.pending:
+            return
+        try:
+            self.conn.send(self.signal)
+        except Exception as e:
+            print(f"Lost D-Bus connection: {e}")
+            self.failures += 1
+            self.disconnect()
+            return
+        self.pending = False
+        self.sent += 1
+
+
+    def disconnect(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
+
+
+    def reconnectLoop(self):
+        notified = False
+        connected = False
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                if self.conn is None:
+                    # Only this thread connects, the lock is taken just to swap the connection in
+                    try:
+                        conn = open_dbus_connection(bus=self.bus)
+                    except Exception as e:
+                        conn = None
+                        if not notified:
+                            print(f"D-Bus {self.bus} not reachable: {e}")
+                            notified = True
+                    if conn is not None:
+                        with self.lock:
+                            self.conn = conn
+                            if connected:
+                                self.reconnects += 1
+                        connected = True
+                        notified = False
+                with self.lock:
+                    if self.conn is not None:
+                        self.flush()
+                    if self.conn is not None and not self.pending:
+                        break
+                time.sleep(RECONNECT_INTERVAL)
+
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.disconnect()
@@ -1,12 +1,14 @@
 #!/env/bin/python
 
-import serial
-import serial.tools.list_ports
 import time
 import re
 import io
 import struct
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from trace_spans import traced
+import ring_log as log
+
+# pyserial and Pillow are imported on first use, so that a handler
+# without a panel attached (installation mode) does not load them at startup
 
 # For handling display with VID F003
 F003_EOF = b'\n'
@@ -21,6 +23,7 @@ def detectCOMPort(vid: str, pid: str):
     If multiple devices with same (vid, pid) connected, the first matches
     device is returned.
     """
+    import serial.tools.list_ports
     for port in serial.tools.list_ports.comports():
         if port.pid == pid and port.vid == vid:
             return port.device
@@ -32,6 +35,7 @@ def openSerialPort(comport: str):
 
     Throws serial.SerialException
     '''
+    import serial
     ser = serial.Serial(port = comport,
                         baudrate = 115200,
                         timeout=0,
@@ -45,7 +49,7 @@ def openSerialPort(comport: str):
 
 class Display():
 
-    def __init__(self, ser: serial.Serial, vid: str, pid: str):
+    def __init__(self, ser: "serial.Serial", vid: str, pid: str):
         self.ser = ser
         self.vid = vid
         self.pid = pid
@@ -154,9 +158,11 @@ class DisplayF002(Display):
         return binary_format
 
 
+    @traced("panel.Send", "display")
     def Send(self, top: str, bottom: str):
         if len(top) != 12 or len(bottom) != 6:
             raise Exception(f"Improper data format. Got {top}, {bottom}")
+        from PIL import Image, ImageDraw, ImageFont, ImageOps
 
         # get a font
         font = ImageFont.truetype(self.Regular_ttf, self.fontsize)
@@ -312,7 +318,7 @@ class DisplayF003(Display):
                     self.display_info_bottom[ord(c)-49] = False
                 else:
                     return
-        print(f"Clearing char: {c}")
+        log.debug("Clearing char: %s", c)
         cmd = f'$9003"{c}"1&{F003_LF}'
         self.ser.write(cmd.encode())
         time.sleep(0.12)
@@ -331,17 +337,18 @@ class DisplayF003(Display):
                     self.display_info_bottom[ord(c)-49] = True
                 else:
                     return
-        print(f"Lighting char: {c}")
+        log.debug("Lighting char: %s", c)
         cmd = f'$9002"{c}"1&{F003_LF}'
         self.ser.write(cmd.encode())
         time.sleep(0.12)
         return
 
+    @traced("panel.Send", "display")
     def Send(self, top: str, bottom: str):
         if len(top) != 12 or len(bottom) != 6:
             raise Exception("Invalid input format")
 
-        print(f"Flusing buffers for {hex(self.vid)}, {hex(self.pid)}")
+        log.debug("Flusing buffers for %#x, %#x", self.vid, self.pid)
         self.Flush()
 
         for i, c in enumerate(top):
@@ -372,38 +379,38 @@ class DisplayF003(Display):
             else:
                 self.lightChar(expected)
 
-        print(f"Current info: {self.display_info_top}, {self.display_info_bottom}")
+        log.debug("Current info: %s, %s", tuple(self.display_info_top), tuple(self.display_info_bottom))
 
     def showInfo(self, gsm_stat=False, tv_stat=False, wmk_stat=False):
         if gsm_stat:
-            print(f"Lighting char: GSM")
+            log.debug("Lighting char: GSM")
             cmd = f'$9002"GSM"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
         else:
-            print(f"Clearing char: GSM")
+            log.debug("Clearing char: GSM")
             cmd = f'$9003"GSM"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
 
         if tv_stat:
-            print(f"Lighting char: TVP")
+            log.debug("Lighting char: TVP")
             cmd = f'$9002"TVP"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
         else:
-            print(f"Clearing char: TVP")
+            log.debug("Clearing char: TVP")
             cmd = f'$9003"TVP"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
         
         if wmk_stat:
-            print(f"Lighting char: WMK")
+            log.debug("Lighting char: WMK")
             cmd = f'$9002"WMK"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
         else:
-            print(f"Clearing char: WMK")
+            log.debug("Clearing char: WMK")
             cmd = f'$9003"WMK"1&{F003_LF}'
             self.ser.write(cmd.encode())
             time.sleep(0.12)
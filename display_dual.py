@@ -1,15 +1,16 @@
 #!/env/bin/python
 
-import serial
-import serial.tools.list_ports
 import time
 import re
 import io
 import struct
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from trace_spans import traced
+import ring_log as log
 from datetime import datetime
 import os
-import smbus2
+
+# pyserial, Pillow and smbus2 are imported on first use, so that a handler
+# without a panel attached (installation mode) does not load them at startup
 
 # For handling I2C related operations
 I2C_CHANNEL = 1
@@ -56,6 +57,7 @@ def detectCOMPort(vid: str, pid: str):
     If multiple devices with same (vid, pid) connected, the first matches
     device is returned.
     """
+    import serial.tools.list_ports
     for port in serial.tools.list_ports.comports():
         if port.pid == pid and port.vid == vid:
             return port.device
@@ -67,6 +69,7 @@ def openSerialPort(comport: str, baud = 230400):
 
     Throws serial.SerialException
     '''
+    import serial
     ser = serial.Serial(port = comport,
                         baudrate = baud,
                         timeout=0,
@@ -80,7 +83,7 @@ def openSerialPort(comport: str, baud = 230400):
 
 class Display():
 
-    def __init__(self, ser: serial.Serial, vid: str, pid: str):
+    def __init__(self, ser: "serial.Serial", vid: str, pid: str):
         self.ser = ser
         self.vid = vid
         self.pid = pid
@@ -117,6 +120,7 @@ class DisplayF002(Display):
         self.W, self.H = (256, 64) # image size
         self.background = (0) # black
         self.fill = "white"
+        import smbus2
         try:
             self.LED_display = smbus2.SMBus(I2C_CHANNEL)
 
@@ -124,11 +128,11 @@ class DisplayF002(Display):
             self.LED_display.write_byte_data(DRV_ADDRESS, 0x00, 0x01)
             print("LED driver init success!")
         except Exception as e:
-            print(e)
+            log.warning("LED driver init failed: %s", e)
             pass
 
     def i2c_led_clearChar(self, c):
-        print(f"Clearing char: {c}")
+        log.debug("Clearing char: %s", c)
         try:
             # Power OFF the LED
             reg_address = LED_REG_BASE+charToChannelNum[c]
@@ -136,7 +140,7 @@ class DisplayF002(Display):
 
             self.LED_display.write_byte_data(DRV_ADDRESS, UPDATE_REG_ADDRESS, 0x00)
         except Exception as e:
-            print(e)
+            log.warning("LED driver write failed: %s", e)
             pass
 
         #time.sleep(0.12)
@@ -144,7 +148,7 @@ class DisplayF002(Display):
 
 
     def i2c_led_lightChar(self, c):
-        print(f"Lighting char: {c}")
+        log.debug("Lighting char: %s", c)
         try:
             # Set LED PWM to the full intensity
             reg_address = PWM_REG_BASE+charToChannelNum[c]
@@ -156,7 +160,7 @@ class DisplayF002(Display):
 
             self.LED_display.write_byte_data(DRV_ADDRESS, UPDATE_REG_ADDRESS, 0x00)
         except Exception as e:
-            print(e)
+            log.warning("LED driver write failed: %s", e)
             pass
 
         #time.sleep(0.12)
@@ -271,6 +275,7 @@ class DisplayF002(Display):
 
     def graphic(self):
 
+        from PIL import Image, ImageOps
         path = '/opt/fluctus/display-handler/v_bmp'
         dir_list = os.listdir(path)
 
@@ -302,6 +307,7 @@ class DisplayF002(Display):
         return
 
     def scroll(self, top: str, bottom: str):
+        from PIL import Image, ImageDraw, ImageFont, ImageOps
         # get a font
         font = ImageFont.truetype(self.Regular_ttf, self.fontsize)
 
@@ -358,7 +364,11 @@ class DisplayF002(Display):
             time.sleep(0.005)
         return
 
-    def Send(self, top: str, bottom: str, mode="viewership"):
+    def Render(self, top: str, bottom: str, mode="viewership"):
+        """
+        Renders a frame into the byte stream understood by the panel
+        """
+        from PIL import Image, ImageDraw, ImageFont, ImageOps
         # get a font
         font = ImageFont.truetype(self.Regular_ttf, self.fontsize)
 
@@ -473,7 +483,14 @@ class DisplayF002(Display):
         flipped_image.save(byteArray, format="bmp")
         byteArray = byteArray.getvalue()
 
-        data = self.bmp_to_arraybyte(byteArray)
+        return self.bmp_to_arraybyte(byteArray)
+
+
+    @traced("panel.Write", "display")
+    def Write(self, data):
+        """
+        Writes a frame produced by `Render`
+        """
         self.PowerOn()
 
         i = 0
@@ -491,6 +508,11 @@ class DisplayF002(Display):
         return
 
 
+    @traced("panel.Send", "display")
+    def Send(self, top: str, bottom: str, mode="viewership"):
+        self.Write(self.Render(top, bottom, mode))
+
+
     def Clear(self):
         self.Flush()
         self.ser.write(bytearray([int(0x1F), int(0x28), int(0x61), int(0x40), int(0)]))
@@ -578,7 +600,7 @@ class DisplayF003(Display):
                     self.display_info_bottom[ord(c)-49] = False
                 else:
                     return
-        print(f"Clearing char: {c}")
+        log.debug("Clearing char: %s", c)
         cmd = f'$9003"{c}"1&{F003_LF}'
         self.ser.write(cmd.encode())
         time.sleep(0.12)
@@ -597,17 +619,18 @@ class DisplayF003(Display):
                     self.display_info_bottom[ord(c)-49] = True
                 else:
                     return
-        print(f"Lighting char: {c}")
+        log.debug("Lighting char: %s", c)
         cmd = f'$9002"{c}"1&{F003_LF}'
         self.ser.write(cmd.encode())
         time.sleep(0.12)
         return
 
+    @traced("panel.Send", "display")
     def Send(self, top: str, bottom: str):
         if len(top) != 12 or len(bottom) != 6:
             raise Exception("Invalid input format")
 
-        print(f"Flusing buffers for {hex(self.vid)}, {hex(self.pid)}")
+        log.debug("Flusing buffers for %#x, %#x", self.vid, self.pid)
         self.Flush()
 
         for i, c in enumerate(top):
@@ -638,7 +661,7 @@ class DisplayF003(Display):
             else:
                 self.lightChar(expected)
 
-        print(f"Current info: {self.display_info_top}, {self.display_info_bottom}")
+        log.debug("Current info: %s, %s", tuple(self.display_info_top), tuple(self.display_info_bottom))
 
 
     def Clear(self):
@@ -0,0 +1,135 @@
+"""
+Encoder/decoder for the events pushed to PUSH_ADDR.
+
+An event is three concatenated msgpack objects: the event version, the
+event type and the body map. The version/type headers and the body keys
+never change, so they are packed once at import and the builders only pack
+the values. The output is byte for byte what
+`packb(version) + packb(type) + packb({...})` produces.
+
+Kept python2 compatible, `cellinfo_hl8518.py` still runs under python2.
+"""
+
+import msgpack
+
+EVENT_VERSION = 1
+EVENT_TYPE_CELL = 1
+EVENT_TYPE_GUEST_REG = 2
+EVENT_TYPE_MEM_GUEST_DECL = 3
+EVENT_TYPE_REMOTE_ACTIVITY = 25
+
+EVENT_TYPES = {
+    EVENT_TYPE_CELL: "cell_info",
+    EVENT_TYPE_GUEST_REG: "guest_registration",
+    EVENT_TYPE_MEM_GUEST_DECL: "declaration",
+    EVENT_TYPE_REMOTE_ACTIVITY: "remote_activity",
+}
+
+MEMBER_KEY_COUNT = 12
+GUEST_KEY_COUNT = 5
+
+PACKER = msgpack.Packer()
+
+HEADERS = dict((t, msgpack.packb(EVENT_VERSION) + msgpack.packb(t)) for t in EVENT_TYPES)
+
+TRUE = msgpack.packb(True)
+FALSE = msgpack.packb(False)
+TRUE_BYTE = bytearray(TRUE)[0]
+FALSE_BYTE = bytearray(FALSE)[0]
+
+
+def _keys(*names):
+    return tuple(msgpack.packb(n) for n in names)
+
+
+GUEST_REG_BODY = PACKER.pack_map_header(4)
+GUEST_REG_KEYS = _keys("Guest_id", "Registering", "Guest_age", "Guest_male")
+
+DECL_BODY = PACKER.pack_map_header(3)
+DECL_KEYS = _keys("Member_Keys", "Guests", "Confidence")
+MEMBER_KEYS_ARRAY = PACKER.pack_array_header(MEMBER_KEY_COUNT)
+GUEST_KEYS_ARRAY = PACKER.pack_array_header(GUEST_KEY_COUNT)
+
+REMOTE_ACTIVITY_BODY = PACKER.pack_map_header(4)
+REMOTE_ACTIVITY_KEYS = _keys("Lock", "ORR", "Absent_Key_Press", "Drop")
+
+CELL_INFO_BODY = PACKER.pack_map_header(2)
+CELL_INFO_KEYS = _keys("Cell_Info", "Installing")
+
+
+# Packed bools for every 6-bit chunk of a key mask, lowest bit first
+BOOL_CHUNKS = [bytes(bytearray(TRUE_BYTE if v >> i & 1 else FALSE_BYTE for i in range(6))) for v in range(64)]
+
+
+def guestRegistrationEvent(guest_id, registering, guest_age, guest_male):
+    k = GUEST_REG_KEYS
+    return b"".join((
+        HEADERS[EVENT_TYPE_GUEST_REG], GUEST_REG_BODY,
+        k[0], PACKER.pack(guest_id),
+        k[1], TRUE if registering else FALSE,
+        k[2], PACKER.pack(guest_age),
+        k[3], TRUE if guest_male else FALSE,
+    ))
+
+
+def declarationEvent(member_mask, guest_mask, confidence=100):
+    """
+    Bit `i` of `member_mask`/`guest_mask` is the i-th member/guest key
+    """
+    k = DECL_KEYS
+    return b"".join((
+        HEADERS[EVENT_TYPE_MEM_GUEST_DECL], DECL_BODY,
+        k[0], MEMBER_KEYS_ARRAY, BOOL_CHUNKS[member_mask & 63], BOOL_CHUNKS[member_mask >> 6 & 63],
+        k[1], GUEST_KEYS_ARRAY, BOOL_CHUNKS[guest_mask & 31][:GUEST_KEY_COUNT],
+        k[2], PACKER.pack(confidence),
+    ))
+
+
+def remoteActivityEvent(absent, lock=False, orr=False, drop=False):
+    k = REMOTE_ACTIVITY_KEYS
+    return b"".join((
+        HEADERS[EVENT_TYPE_REMOTE_ACTIVITY], REMOTE_ACTIVITY_BODY,
+        k[0], PACKER.pack(lock),
+        k[1], PACKER.pack(orr),
+        k[2], PACKER.pack(absent),
+        k[3], PACKER.pack(drop),
+    ))
+
+
+def cellInfoEvent(cell_infos, installing=False):
+    k = CELL_INFO_KEYS
+    return b"".join((
+        HEADERS[EVENT_TYPE_CELL], CELL_INFO_BODY,
+        k[0], PACKER.pack(cell_infos),
+        k[1], PACKER.pack(installing),
+    ))
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def decodeEvent(data):
+    """
+    Returns `(version, event_type, body)`, raises `InvalidEvent` if `data`
+    is not a well formed event of a known type.
+    """
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(data)
+    try:
+        version = unpacker.unpack()
+        event_type = unpacker.unpack()
+        body = unpacker.unpack()
+    except (msgpack.OutOfData, ValueError) as e:
+        raise InvalidEvent("Truncated or malformed event: %s" % e)
+    if version != EVENT_VERSION:
+        raise InvalidEvent("Unknown event version %r" % (version,))
+    if event_type not in EVENT_TYPES:
+        raise InvalidEvent("Unknown event type %r" % (event_type,))
+    if not isinstance(body, dict):
+        raise InvalidEvent("Event body is not a map")
+    try:
+        unpacker.unpack()
+    except msgpack.OutOfData:
+        return version, event_type, body
+    raise InvalidEvent("Trailing data after event body")
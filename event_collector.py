@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+"""
+Local stand-in for the PUSH_ADDR event consumer.
+
+Binds the datagram address `state.py` and `cellinfo_hl8518.py` push to,
+validates every event with `event_codec.decodeEvent` and reports
+throughput, per type counts, payload sizes and inter-arrival times.
+
+    event_collector.py [--address PATH] [--capture FILE] [--interval S] [--duration S]
+    event_collector.py --summary FILE
+    event_collector.py --replay FILE [--address PATH] [--speed X]
+
+A capture file holds one spool-framed record per datagram, prefixed with
+its arrival time, so it can be summarised offline or replayed against
+another consumer with the original spacing.
+"""
+
+import argparse
+import bisect
+import os
+import socket
+import struct
+import time
+
+import event_codec
+from event_spool import frame, records
+
+COLLECTOR_ADDR = os.environ.get("PUSH_ADDR") or "/tmp/push_addr"
+MAX_DATAGRAM = 65536
+ARRIVAL = struct.Struct("<d")
+# Upper bounds of the inter-arrival histogram buckets, in milliseconds
+GAP_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+
+
+class CollectorStats():
+
+    def __init__(self):
+        self.started_at = None
+        self.last_at = None
+        self.events = 0
+        self.invalid = 0
+        self.bytes = 0
+        self.types = {}
+        self.sizes = {}
+        self.gaps = [0] * (len(GAP_BUCKETS_MS) + 1)
+        self.max_gap = 0.0
+
+
+    def record(self, data: bytes, at: float):
+        """
+        Accounts for one datagram that arrived at `at`, returns the decoded
+        `(version, type, body)` or None if it was not a valid event.
+        """
+        if self.started_at is None:
+            self.started_at = at
+        else:
+            gap = at - self.last_at
+            self.gaps[bisect.bisect_left(GAP_BUCKETS_MS, gap * 1000)] += 1
+            self.max_gap = max(self.max_gap, gap)
+        self.last_at = at
+        self.events += 1
+        self.bytes += len(data)
+        try:
+            event = event_codec.decodeEvent(data)
+        except event_codec.InvalidEvent as e:
+            self.invalid += 1
+            print(f"Invalid event ({len(data)} bytes): {e}")
+            return None
+        name = event_codec.EVENT_TYPES[event[1]]
+        self.types[name] = self.types.get(name, 0) + 1
+        low, high, total = self.sizes.get(name, (len(data), len(data), 0))
+        self.sizes[name] = (min(low, len(data)), max(high, len(data)), total + len(data))
+        return event
+
+
+    def report(self) -> str:
+        elapsed = (self.last_at - self.started_at) if self.events > 1 else 0
+        rate = self.events / elapsed if elapsed else 0
+        lines = [f"{self.events} events, {self.invalid} invalid, {self.bytes} bytes in {elapsed:.1f}s ({rate:.1f} events/s)"]
+        for name, count in sorted(self.types.items()):
+            low, high, total = self.sizes[name]
+            lines.append(f"  {name:<20} {count:>8}  size min/avg/max {low}/{total // count}/{high}")
+        if self.events > 1:
+            labels = [f"<={b}ms" for b in GAP_BUCKETS_MS] + [f">{GAP_BUCKETS_MS[-1]}ms"]
+            lines.append("  inter-arrival " + " ".join(f"{l}:{n}" for l, n in zip(labels, self.gaps) if n) + f" max {self.max_gap * 1000:.1f}ms")
+        return "\n".join(lines)
+
+
+class EventCollector():
+
+    def __init__(self, address: str = COLLECTOR_ADDR, capture: str = None):
+        self.address = address
+        if os.path.exists(address):
+            os.unlink(address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.capture = open(capture, "ab") if capture else None
+        self.stats = CollectorStats()
+        self.events = []
+        self.keep_events = False
+
+
+    def poll(self, timeout: float = None) -> bool:
+        """
+        Waits up to `timeout` seconds for one datagram, True if one arrived
+        """
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(MAX_DATAGRAM)
+        except socket.timeout:
+            return False
+        at = time.time()
+        event = self.stats.record(data, at)
+        if self.keep_events and event is not None:
+            self.events.append(event)
+        if self.capture is not None:
+            self.capture.write(frame(ARRIVAL.pack(at) + data))
+        return True
+
+
+    def run(self, interval: float = 10, duration: float = None):
+        stop_at = time.monotonic() + duration if duration else None
+        report_at = time.monotonic() + interval
+        try:
+            while stop_at is None or time.monotonic() < stop_at:
+                self.poll(1)
+                if time.monotonic() >= report_at:
+                    print(self.stats.report())
+                    report_at += interval
+        except KeyboardInterrupt:
+            pass
+        print(self.stats.report())
+
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.address)
+        if self.capture is not None:
+            self.capture.close()
+
+
+def readCapture(path: str):
+    """
+    Yields `(arrived_at, datagram)` for every record of a capture file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    for _, body in records(data):
+        yield ARRIVAL.unpack_from(body)[0], bytes(body[ARRIVAL.size:])
+
+
+def summarise(path: str) -> str:
+    stats = CollectorStats()
+    for at, data in readCapture(path):
+        stats.record(data, at)
+    return stats.report()
+
+
+def replay(path: str, address: str = COLLECTOR_ADDR, speed: float = 1.0) -> int:
+    """
+    Sends a capture to `address` with its original spacing divided by
+    `speed`, as fast as possible if `speed` is 0. Returns the events sent.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.connect(address)
+    sent = 0
+    first = None
+    started = time.monotonic()
+    for at, data in readCapture(path):
+        if first is None:
+            first = at
+        if speed:
+            delay = (at - first) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        sock.send(data)
+        sent += 1
+    sock.close()
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reference PUSH_ADDR event consumer")
+    parser.add_argument("--address", default=COLLECTOR_ADDR)
+    parser.add_argument("--capture", help="append every received datagram to this file")
+    parser.add_argument("--interval", type=float, default=10, help="seconds between reports")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--summary", metavar="FILE", help="report on a capture file and exit")
+    parser.add_argument("--replay", metavar="FILE", help="send a capture file to --address and exit")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up, 0 for no delays")
+    args = parser.parse_args()
+
+    if args.summary:
+        print(summarise(args.summary))
+    elif args.replay:
+        print(f"Replayed {replay(args.replay, args.address, args.speed)} events")
+    else:
+        collector = EventCollector(args.address, args.capture)
+        print(f"Collecting events on {args.address}")
+        try:
+            collector.run(args.interval, args.duration)
+        finally:
+            collector.close()
+
+
+if __name__ == "__main__":
+    main()
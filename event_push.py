@@ -0,0 +1,161 @@
+"""
+Long-lived datagram connection to the PUSH_ADDR event consumer.
+
+Events are sent over one connected `AF_UNIX` socket that is re-opened when
+a send fails. Events produced inside `batch()` are held back and flushed
+together when the outermost batch exits, so one state transition costs one
+back-to-back burst of sends. Every event remains its own datagram, which is
+what the consumer expects.
+
+With a spool attached, events that cannot be delivered are written to it
+instead of raising. While the spool holds events, new ones are appended
+behind them to keep the order, and `retry()` replays the backlog at most
+every `SPOOL_RETRY_INTERVAL` seconds. `on_backpressure(True)` is called when
+the backlog crosses `SPOOL_HIGH_WATERMARK` of the spool size and
+`on_backpressure(False)` once it has drained below it. Without a spool the
+events are dropped and counted in `dropped`. `on_sent(body)` is called for
+every new event that reached the consumer, not for the ones replayed from
+the spool.
+"""
+
+import contextlib
+import socket
+import time
+
+SPOOL_RETRY_INTERVAL = 5
+SPOOL_HIGH_WATERMARK = 0.75
+
+
+class EventPusher():
+
+    def __init__(self, address: str, spool=None, on_backpressure=None, on_sent=None):
+        self.address = address
+        self.spool = spool
+        self.on_backpressure = on_backpressure
+        self.on_sent = on_sent
+        self.congested = False
+        self.retry_at = 0
+        self.sock = None
+        self.queue = []
+        self.depth = 0
+        self.connected_once = False
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.reconnects = 0
+
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        if self.connected_once:
+            self.reconnects += 1
+        self.connected_once = True
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+    def sendOne(self, body: bytes, replayed: bool = False):
+        """
+        Sends one datagram, reconnecting once if the socket went stale.
+
+        Raises OSError if the consumer stays unreachable.
+        """
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.send(body)
+                self.sent += 1
+                if self.on_sent is not None and not replayed:
+                    self.on_sent(body)
+                return
+            except OSError:
+                self.failures += 1
+                self.close()
+                if attempt:
+                    raise
+
+
+    def send(self, body: bytes):
+        self.queue.append(body)
+        if not self.depth:
+            self.flush()
+
+
+    @property
+    def backlogged(self) -> bool:
+        return self.spool is not None and self.spool.pending > 0
+
+
+    def flush(self):
+        queue, self.queue = self.queue, []
+        if not queue:
+            return
+        if self.backlogged and not self.retry():
+            self.spoolEvents(queue)
+            return
+        for i, body in enumerate(queue):
+            try:
+                self.sendOne(body)
+            except OSError as e:
+                if self.spool is None:
+                    self.dropped += len(queue) - i
+                    print(f"Event consumer unreachable, dropped {len(queue) - i} events: {e}")
+                    return
+                self.spoolEvents(queue[i:])
+                return
+
+
+    def spoolEvents(self, bodies):
+        if not self.backlogged:
+            self.retry_at = time.monotonic() + SPOOL_RETRY_INTERVAL
+        self.spool.append(bodies)
+        self.checkBackpressure()
+
+
+    def retry(self, force=False) -> bool:
+        """
+        Replays the spooled backlog if it is time to, returns True once
+        the backlog is gone.
+        """
+        if not self.backlogged:
+            return True
+        if not force and time.monotonic() < self.retry_at:
+            return False
+        drained = self.spool.replay(lambda body: self.sendOne(body, replayed=True))
+        if not drained:
+            self.retry_at = time.monotonic() + SPOOL_RETRY_INTERVAL
+        self.checkBackpressure()
+        return drained
+
+
+    def checkBackpressure(self):
+        congested = self.spool.size >= self.spool.max_bytes * SPOOL_HIGH_WATERMARK
+        if congested != self.congested:
+            self.congested = congested
+            if self.on_backpressure is not None:
+                self.on_backpressure(congested)
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Holds back the events sent inside the block and flushes them on exit
+        """
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.flush()
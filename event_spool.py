@@ -0,0 +1,191 @@
+"""
+Append-only on-disk spool for events the PUSH_ADDR consumer did not take.
+
+Every record is framed as `<length u32><crc32 u32><body>`. A torn or
+corrupted record ends the readable part of the spool; it and anything
+after it is discarded when the spool is opened.
+
+The spool is capped at `max_bytes`. When an append would overflow it the
+`policy` decides what is lost, and every lost event is counted in
+`dropped`:
+    DROP_OLDEST - compact away the oldest records to make room (default)
+    DROP_NEWEST - refuse the new record
+Once opened the spool does not raise: when the storage fails a write
+(disk full, I/O error) the new records are dropped and counted the same
+way, and when it fails to remove replayed records they stay spooled and
+are sent again.
+"""
+
+import os
+import struct
+import zlib
+
+SPOOL_PATH = os.environ.get("EVENT_SPOOL_PATH", "/var/data/display-handler.spool")
+SPOOL_MAX_BYTES = int(os.environ.get("EVENT_SPOOL_MAX_BYTES", 1024*1024))
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+FRAME = struct.Struct("<II")
+
+
+def frame(body: bytes) -> bytes:
+    return FRAME.pack(len(body), zlib.crc32(body)) + body
+
+
+def records(data):
+    """
+    Yields `(end_offset, body)` for every intact record in `data`
+    """
+    view = memoryview(data)
+    offset = 0
+    while offset + FRAME.size <= len(view):
+        length, crc = FRAME.unpack_from(view, offset)
+        start = offset + FRAME.size
+        end = start + length
+        if end > len(view):
+            return
+        body = view[start:end]
+        if zlib.crc32(body) != crc:
+            return
+        yield end, body
+        offset = end
+
+
+class EventSpool():
+
+    def __init__(self, path: str = SPOOL_PATH, max_bytes: int = SPOOL_MAX_BYTES, policy: str = DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown spool drop policy: {policy}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = 0
+        self.pending = 0
+        for end, _ in records(self.read()):
+            self.size = end
+            self.pending += 1
+        if self.size != os.fstat(self.fd).st_size:
+            print(f"Discarding {os.fstat(self.fd).st_size - self.size} corrupt bytes at the end of {path}")
+            os.ftruncate(self.fd, self.size)
+
+
+    def read(self) -> bytes:
+        return os.pread(self.fd, os.fstat(self.fd).st_size, 0)
+
+
+    def append(self, bodies) -> int:
+        """
+        Durably appends `bodies`, returns how many of them were kept
+        """
+        data = b"".join(frame(b) for b in bodies)
+        count = len(bodies)
+        if self.size + len(data) > self.max_bytes:
+            if self.policy == DROP_NEWEST or len(data) > self.max_bytes:
+                self.dropped += count
+                print(f"Event spool full, dropped {count} new events")
+                return 0
+        try:
+            if self.size + len(data) > self.max_bytes:
+                self.compact(self.size + len(data) - self.max_bytes)
+            os.write(self.fd, data)
+            os.fsync(self.fd)
+        except OSError as e:
+            self.dropped += count
+            print(f"Could not write the event spool, dropped {count} new events: {e}")
+            self.truncate()
+            return 0
+        self.size += len(data)
+        self.pending += count
+        self.spooled += count
+        return count
+
+
+    def compact(self, skip_bytes: int):
+        """
+        Drops the oldest records covering at least `skip_bytes`
+        """
+        dropped = 0
+        end = 0
+        data = self.read()
+        for end, _ in records(data):
+            dropped += 1
+            if end >= skip_bytes:
+                break
+        self.rewrite(data[end:])
+        self.pending -= dropped
+        self.dropped += dropped
+        print(f"Event spool full, dropped {dropped} oldest events")
+
+
+    def truncate(self):
+        """
+        Cuts off whatever a failed append left behind the intact records
+        """
+        try:
+            os.ftruncate(self.fd, self.size)
+        except OSError as e:
+            print(f"Could not truncate the event spool: {e}")
+
+
+    def rewrite(self, data: bytes):
+        """
+        Atomically replaces the spool content with `data`
+        """
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self.path)
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        os.close(self.fd)
+        self.fd = fd
+        self.size = len(data)
+
+
+    def replay(self, send) -> bool:
+        """
+        Feeds the spooled events to `send` in order, stopping at the first
+        `OSError`. Delivered events are removed from the spool.
+
+        Returns True once the spool is empty.
+        """
+        if not self.pending:
+            return True
+        try:
+            data = self.read()
+        except OSError as e:
+            print(f"Could not read the event spool: {e}")
+            return False
+        delivered = 0
+        offset = 0
+        try:
+            for end, body in records(data):
+                send(bytes(body))
+                delivered += 1
+                offset = end
+        except OSError:
+            pass
+        if delivered:
+            self.replayed += delivered
+            try:
+                if delivered < self.pending:
+                    self.rewrite(data[offset:self.size])
+                else:
+                    os.ftruncate(self.fd, 0)
+                    self.size = 0
+                self.pending -= delivered
+                os.fsync(self.fd)
+            except OSError as e:
+                print(f"Could not remove {delivered} replayed events from the event spool: {e}")
+        return not self.pending
+
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,501 @@
+#!/usr/bin/python3
+"""
+Fleet load simulator for the display handler.
+
+Runs N `DisplayHandler` state machines in one process, one thread each,
+against emulated panels, an in-memory DB, a scripted status provider and
+the reference event collector. Every household gets a synthetic remote
+key stream:
+    declaration  - member toggles, ABS and OK presses
+    guest        - GUEST / G<n> / <age group> / OK registration flows
+    tv-flap      - TV status flapping between declarations
+    installation - installation mode toggles between declarations
+    mixed        - the above spread over the households (default)
+
+    fleet_sim.py [--module state|state_dual] [--instances 1 10 50] [--duration S]
+                 [--scenario NAME] [--rate KEYS_PER_S] [--tick S] [--per-instance]
+
+Every round reports key-to-screen latency (key read by the panel until
+the next frame is written), keys, frames and events per second, and the
+process CPU and memory use. All households are BM3 meters, the pre-BM3
+installation mode path sleeps for a minute per toggle.
+"""
+
+import argparse
+import collections
+import contextlib
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+
+from event_collector import EventCollector, CollectorStats
+from event_spool import EventSpool
+from loop_watchdog import LoopWatchdog
+from memory_trace import MemoryTracer
+from metrics_textfile import MetricsWriter
+
+SCENARIOS = ("declaration", "guest", "tv-flap", "installation")
+GUEST_IDENTITIES = [f"{g}{n}" for g in "MF" for n in range(1, 6)]
+
+CURRENT = threading.local()
+
+
+class SimulationDone(Exception):
+    pass
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p))]
+
+
+class Household():
+    """
+    Scripted inputs of one meter and what its handler did with them
+    """
+
+    def __init__(self, index: int, scenario: str, rate: float, rng: random.Random):
+        self.index = index
+        self.scenario = scenario
+        self.rate = rate
+        self.rng = rng
+        self.members = [chr(65+i) for i in range(rng.randint(2, 12))]
+        self.tv = True
+        self.paired = True
+        self.installation = False
+        # wm, gsm, uploader, tv and installation mode, as on the status board
+        self.board = [1, 1, 1, 1, 0]
+        self.rows = {}
+        # Handlers warm start from this, it is what a freshly installed meter would snapshot
+        self.snapshot = {
+            "is_bm3": True,
+            "cleared_aud": None,
+            "registered": list(self.members),
+            "guests": [],
+            "declared": 0,
+            "absent": False,
+            "tv": True,
+            "brightness": 255,
+            "installation": False,
+            "panel_names": [f"Member {m}" for m in self.members],
+        }
+        self.script = collections.deque()
+        self.started_at = None
+        self.stop_at = None
+        self.pressed_at = None
+        self.keys = 0
+        self.frames = 0
+        self.writes = 0
+        self.notifications = 0
+        self.buzzes = 0
+        self.latencies = []
+        self.handler = None
+        self.error = None
+
+
+    def start(self, duration: float):
+        self.started_at = time.monotonic()
+        self.stop_at = self.started_at + duration
+        at = 0.0
+        while at < duration:
+            for delay, action in self.actions():
+                at += delay
+                self.script.append((self.started_at + at, action))
+
+
+    def actions(self):
+        """
+        Yields one burst of `(delay, action)`, an action being a key name
+        or a `(status, value)` change.
+        """
+        rng = self.rng
+        gap = lambda: rng.expovariate(self.rate)
+        if self.scenario == "guest":
+            yield gap(), "GUEST"
+            yield gap(), f"G{rng.randint(1, 5)}"
+            yield gap(), rng.choice(GUEST_IDENTITIES)
+            yield gap(), rng.choice(("OK", "OK", "OK", "CANCEL"))
+        elif self.scenario == "tv-flap":
+            yield gap(), ("tv", not self.tv)
+            self.tv = not self.tv
+            yield gap(), rng.choice(self.members)
+        elif self.scenario == "installation":
+            yield gap() * 5, ("installation", not self.installation)
+            self.installation = not self.installation
+            yield gap(), rng.choice(self.members)
+        else:
+            for _ in range(rng.randint(1, 4)):
+                yield gap(), rng.choice(self.members)
+            yield gap(), rng.choice(("OK", "ABS", "INFO", "OK"))
+
+
+    def nextKey(self):
+        """
+        Applies the status changes that are due, returns the next key that
+        is due or None.
+        """
+        now = time.monotonic()
+        if now >= self.stop_at:
+            raise SimulationDone()
+        while self.script and self.script[0][0] <= now:
+            _, action = self.script.popleft()
+            if isinstance(action, tuple):
+                status, value = action
+                if status == "tv":
+                    self.board[3] = int(value)
+                else:
+                    self.board[4] = int(value)
+                continue
+            self.keys += 1
+            self.pressed_at = now
+            return action
+        return None
+
+
+    def frameSent(self):
+        self.frames += 1
+        if self.pressed_at is not None:
+            self.latencies.append(time.monotonic() - self.pressed_at)
+            self.pressed_at = None
+
+
+class SimPanel():
+    """
+    Emulated display and IR receiver, every method the handler calls that
+    is not defined here is a no-op.
+    """
+
+    vid = 0x2047
+    pid = 0xf002
+
+    def __init__(self, household: Household, key_codes: dict):
+        self.household = household
+        self.key_codes = key_codes
+        self.toggle = 0
+
+
+    def ReadRemoteCmd(self):
+        key = self.household.nextKey()
+        if key is None:
+            return 0
+        self.toggle ^= 1
+        return 0xC003 | self.toggle << 13 | self.key_codes[key] << 2
+
+
+    def Send(self, *args, **kwargs):
+        self.household.frameSent()
+
+
+    def Render(self, top, bottom, mode="viewership"):
+        return (top, bottom, mode)
+
+
+    def Write(self, data):
+        self.household.frameSent()
+
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class SimDB():
+    """
+    In-memory stand-in for `db.DBInterface`, rows live on the household
+    """
+
+    viewershipConn = "viewership"
+    guestRegistrationConn = "guest_registration"
+
+    def __init__(self):
+        self.household = CURRENT.household
+        self.rows = self.household.rows
+
+
+    def saveState(self, conn, key, value):
+        self.rows[key] = value
+        self.household.writes += 1
+
+
+    def loadClearedAud(self):
+        return self.rows.get("cleared_for_aud")
+
+
+    def loadGuestRegistration(self):
+        return json.loads(self.rows.get("guests_registered", "[]"))
+
+
+    def loadDeclaration(self):
+        return json.loads(self.rows.get("declared_viewers", "[]"))
+
+
+    def getAbsentStatus(self):
+        return bool(self.rows.get("absent", 0))
+
+
+    def loadTVState(self):
+        return bool(self.rows.get("last_known_tv_state", 1))
+
+
+    def loadBrightnessLevel(self):
+        return int(self.rows.get("brightness_level", 255))
+
+
+    def loadInstallationModeState(self):
+        return self.rows.get("in_installation_mode") == "True"
+
+
+class SimNotifier():
+
+    def __init__(self, bus=None):
+        self.household = CURRENT.household
+        self.sent = 0
+        self.failures = 0
+        self.reconnects = 0
+
+
+    def notify(self):
+        self.household.notifications += 1
+        self.sent += 1
+
+
+class SimSnapshots():
+    """
+    Keeps each household's state snapshot in memory
+    """
+
+    def load(self, path=None):
+        return CURRENT.household.snapshot
+
+
+    def save(self, state, path=None):
+        CURRENT.household.snapshot = state
+
+
+class FastTime():
+    """
+    `time` for the handler module with its polling sleeps capped to `tick`
+    """
+
+    def __init__(self, tick: float):
+        self.tick = tick
+
+
+    def sleep(self, seconds):
+        time.sleep(min(seconds, self.tick))
+
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def importHandlerModule(name: str):
+    """
+    Imports the handler module without the hardware backed `db` and
+    `display` modules, returns it with the placeholders as `db` and `dsp`.
+    """
+    db = types.ModuleType("db")
+    display = types.ModuleType("display")
+    sys.modules["db"] = db
+    sys.modules["display"] = display
+    return importlib.import_module(name)
+
+
+def loadHandlerModule(name: str, address: str, workdir: str, tick: float = None):
+    """
+    Imports the handler module with its devices and services replaced by
+    the emulated ones.
+    """
+    os.environ["PUSH_ADDR"] = address
+    module = importHandlerModule(name)
+    module.db.DBInterface = SimDB
+
+    probe = types.SimpleNamespace()
+    module.Remote.declareKeyMaps(probe)
+    key_codes = probe.KeyToNum
+
+    def init():
+        panel = SimPanel(CURRENT.household, key_codes)
+        if name == "state_dual":
+            return panel, panel
+        return panel
+
+    module.dsp.init = init
+    module.snapshot = SimSnapshots()
+    module.StateChangeNotifier = SimNotifier
+    module.EventSpool = lambda: EventSpool(os.path.join(workdir, f"spool-{CURRENT.household.index}"))
+    module.MetricsWriter = lambda: MetricsWriter(os.path.join(workdir, f"metrics-{CURRENT.household.index}.prom"))
+    module.LoopWatchdog = lambda describe: LoopWatchdog(describe, path=os.path.join(workdir, f"stalls-{CURRENT.household.index}"))
+    module.MemoryTracer = lambda: MemoryTracer(os.path.join(workdir, f"memtrace-{CURRENT.household.index}"),
+                                               os.path.join(workdir, f"memtrace-{CURRENT.household.index}.txt"))
+    module.MEMBER_CONFIG_PATH = None
+    module.AUDIENCE_SESSION_CLOSE_TIME = "23:59:59"
+    if tick is not None:
+        module.time = FastTime(tick)
+
+    class SimHandler(module.DisplayHandler):
+
+        def __init__(self, household: Household):
+            self.household = household
+            super().__init__()
+
+
+        def getTvStatus(self):
+            return bool(self.household.board[3])
+
+
+        def is_remote_associated(self):
+            return self.household.paired
+
+
+        def checkInstallationMode(self):
+            return bool(self.household.board[4])
+
+
+        def boardValue(self, field: int):
+            return self.household.board[field]
+
+
+        def readMemberConfig(self, member_info=None):
+            if self.in_installation_mode:
+                return self.defaultRegMembers()
+            return list(self.household.members)
+
+
+        def readPanelNames(self, member_info=None):
+            return list(self.household.snapshot["panel_names"])
+
+
+        def buzz(self):
+            self.household.buzzes += 1
+
+    module.SimHandler = SimHandler
+    return module
+
+
+def runHousehold(module, household: Household, duration: float):
+    CURRENT.household = household
+    try:
+        household.handler = module.SimHandler(household)
+        household.start(duration)
+        household.handler.run()
+    except SimulationDone:
+        pass
+    except Exception:
+        household.error = traceback.format_exc()
+    finally:
+        # A finished household no longer beats, its watchdog would report stalls
+        if household.handler is not None:
+            household.handler.watchdog.stop()
+
+
+def residentBytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def runRound(module, collector: EventCollector, instances: int, args) -> dict:
+    collector.stats = CollectorStats()
+    rng = random.Random(args.seed)
+    scenarios = SCENARIOS if args.scenario == "mixed" else (args.scenario,)
+    households = [Household(i, scenarios[i % len(scenarios)], args.rate, random.Random(rng.random())) for i in range(instances)]
+    threads = [threading.Thread(target=runHousehold, args=(module, h, args.duration), name=f"household-{h.index}", daemon=True) for h in households]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(args.duration + 30)
+    wall = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    latencies = [l for h in households for l in h.latencies]
+    return {
+        "instances": instances,
+        "households": households,
+        "wall": wall,
+        "keys": sum(h.keys for h in households),
+        "frames": sum(h.frames for h in households),
+        "db_writes": sum(h.writes for h in households),
+        "events": collector.stats.events,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "max": max(latencies, default=0.0),
+        "cpu": cpu / wall * 100,
+        "rss": residentBytes(),
+        "errors": sum(1 for h in households if h.error),
+        "stuck": sum(1 for t in threads if t.is_alive()),
+    }
+
+
+def printRound(result: dict, per_instance: bool, out):
+    wall = result["wall"]
+    print(f"{result['instances']:>9} {result['keys'] / wall:>8.1f} {result['frames'] / wall:>9.1f} {result['events'] / wall:>9.1f} "
+          f"{result['db_writes'] / wall:>9.1f} {result['p50'] * 1000:>7.1f} {result['p95'] * 1000:>7.1f} {result['max'] * 1000:>7.1f} "
+          f"{result['cpu']:>6.1f} {result['rss'] / 2**20:>7.1f} {result['errors']:>6} {result['stuck']:>6}", file=out)
+    if per_instance:
+        for h in result["households"]:
+            print(f"    #{h.index:<4} {h.scenario:<13} keys {h.keys:<5} frames {h.frames:<5} writes {h.writes:<5} "
+                  f"p50 {percentile(h.latencies, 0.5) * 1000:.1f}ms p95 {percentile(h.latencies, 0.95) * 1000:.1f}ms", file=out)
+    for h in result["households"]:
+        if h.error:
+            print(f"    #{h.index} failed:\n{h.error}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many display handlers against emulated devices")
+    parser.add_argument("--module", default="state", choices=("state", "state_dual"))
+    parser.add_argument("--instances", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=30, help="seconds per round")
+    parser.add_argument("--scenario", default="mixed", choices=("mixed",) + SCENARIOS)
+    parser.add_argument("--rate", type=float, default=2, help="mean key presses per second per household")
+    parser.add_argument("--tick", type=float, help="cap the handler's polling sleeps to this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-instance", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep the handlers' own output")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    with tempfile.TemporaryDirectory(prefix="fleet-sim-") as workdir:
+        address = os.path.join(workdir, "push_addr")
+        collector = EventCollector(address)
+        module = loadHandlerModule(args.module, address, workdir, args.tick)
+        stop = threading.Event()
+
+        def collect():
+            while not stop.is_set():
+                collector.poll(0.5)
+
+        collector_thread = threading.Thread(target=collect, name="collector", daemon=True)
+        collector_thread.start()
+
+        print(f"{'instances':>9} {'keys/s':>8} {'frames/s':>9} {'events/s':>9} {'writes/s':>9} {'p50 ms':>7} {'p95 ms':>7} "
+              f"{'max ms':>7} {'cpu %':>6} {'rss MB':>7} {'errors':>6} {'stuck':>6}", file=out)
+        sink = open(os.devnull, "w")
+        try:
+            for instances in args.instances:
+                with contextlib.redirect_stdout(out if args.verbose else sink):
+                    result = runRound(module, collector, instances, args)
+                printRound(result, args.per_instance, out)
+        finally:
+            stop.set()
+            collector_thread.join()
+            collector.close()
+            sink.close()
+
+
+if __name__ == "__main__":
+    main()
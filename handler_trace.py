@@ -0,0 +1,557 @@
+#!/usr/bin/python3
+"""
+Record/replay of everything the display handler reads.
+
+Recording is switched on with `DISPLAY_HANDLER_RECORD=<path>`. The handler
+then appends its inputs to the trace as they are read: raw IR codes, the
+status board and command lookups (TV, remote pairing, installation
+sentinel, wm/SIM/uploader status, MEMBER_INFO, meter id), the DB and
+snapshot loads at start, member config file changes and wall-clock
+steps. Polled values are only written when they change and IR codes only
+when a key was read, so a household day stays small. The events the
+handler produced are recorded too, as the expected output.
+
+    handler_trace.py replay TRACE [--speed N] [--verbose]
+    handler_trace.py dump TRACE
+
+`replay` runs the recorded handler module against emulated devices that
+play the trace back on a virtual clock: a `time.sleep()` of the handler
+advances the clock instead of waiting, so a day replays in seconds.
+Every poll sees the value recorded last before the virtual time and a key
+is read at the first poll after it was recorded, so the ordering of keys
+and status changes holds to one polling tick. The replayed events must be
+byte for byte the recorded ones, otherwise the first difference is shown
+and the exit status is 1. `--speed` paces the replay at N times real time.
+
+Every record is `[t, channel, key, value]` msgpack, t being seconds since
+the recording started, framed like the event spool so a trace cut short
+by a crash or power loss is readable up to its last whole record.
+"""
+
+import argparse
+import bisect
+import collections
+import contextlib
+import datetime
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import msgpack
+
+from config_watch import FileWatch
+import event_codec
+from event_push import EventPusher
+from event_spool import EventSpool, frame, records
+from loop_watchdog import LoopWatchdog
+from memory_trace import MemoryTracer
+from metrics_textfile import MetricsWriter
+
+RECORD_PATH = os.environ.get("DISPLAY_HANDLER_RECORD")
+RECORD_MAX_BYTES = int(os.environ.get("DISPLAY_HANDLER_RECORD_MAX_BYTES", 64*1024*1024))
+TRACE_VERSION = 1
+WALL_STEP = 1.0
+END_MARGIN = 5.0
+
+HEADER = "header"
+WALL = "wall"
+IR = "ir"
+WATCH = "watch"
+EVENT = "event"
+STREAMS = (IR, WATCH, EVENT)
+
+
+class ReplayDone(Exception):
+    pass
+
+
+class TraceMiss(Exception):
+    pass
+
+
+def proxyModule(module, **overrides):
+    """
+    Copy of `module` with some attributes replaced, for patching one
+    handler module without touching the others importing `module`
+    """
+    proxy = types.ModuleType(module.__name__)
+    proxy.__dict__.update(module.__dict__)
+    proxy.__dict__.update(overrides)
+    return proxy
+
+
+def describePanels(result):
+    describe = lambda panel: [panel.vid, panel.pid] if panel else None
+    if isinstance(result, tuple):
+        return {"tuple": True, "panels": [describe(p) for p in result]}
+    return {"tuple": False, "panels": [describe(result)]}
+
+
+class TraceWriter():
+
+    def __init__(self, path: str, header: dict, max_bytes: int = RECORD_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.started = time.monotonic()
+        self.wall_offset = time.time() - self.started
+        self.last = {}
+        self.size = 0
+        self.full = False
+        self.file = open(path, "wb")
+        header.update(version=TRACE_VERSION, wall=self.wall_offset + self.started, monotonic=self.started,
+                      utcoffset=time.localtime().tm_gmtoff)
+        self.write(HEADER, None, header)
+
+
+    def write(self, channel: str, key, value):
+        if self.full:
+            return
+        body = frame(msgpack.packb([time.monotonic() - self.started, channel, key, value]))
+        if self.size + len(body) > self.max_bytes:
+            self.full = True
+            print(f"Handler trace {self.path} reached {self.max_bytes} bytes, recording stopped")
+            return
+        try:
+            self.file.write(body)
+            self.file.flush()
+        except OSError as e:
+            self.full = True
+            print(f"Could not write handler trace {self.path}: {e}")
+            return
+        self.size += len(body)
+
+
+    def sample(self, channel: str, key, value):
+        """
+        Records a polled input if it changed, returns it
+        """
+        offset = time.time() - time.monotonic()
+        if abs(offset - self.wall_offset) > WALL_STEP:
+            self.wall_offset = offset
+            self.write(WALL, None, offset + self.started)
+        if self.last.get((channel, key), self) != value:
+            self.last[(channel, key)] = value
+            self.write(channel, key, value)
+        return value
+
+
+def record(module, path: str = RECORD_PATH):
+    """
+    Makes the handler `module` record its inputs to `path`, before its
+    `DisplayHandler` is created.
+    """
+    name = os.path.splitext(os.path.basename(module.__file__))[0]
+    trace = TraceWriter(path, {
+        "module": name,
+        "close_time": module.AUDIENCE_SESSION_CLOSE_TIME,
+        "member_config": bool(module.MEMBER_CONFIG_PATH),
+    })
+    print(f"Recording handler inputs to {path}")
+    commands, snapshot, status_board, display, db = module.commands, module.snapshot, module.status_board, module.dsp, module.db
+
+    def getoutput(cmd, name=None):
+        return trace.sample("getoutput", cmd, commands.getoutput(cmd, name=name))
+
+    def loadSnapshot(*args):
+        return trace.sample("snapshot", "load", snapshot.load(*args))
+
+    def openBoard(*args):
+        board = status_board.StatusBoard.open(*args)
+        if trace.sample("board", "open", board is not None):
+            get = board.get
+            board.get = lambda field: trace.sample("board", field, get(field))
+        return board
+
+    def initDisplay():
+        result = display.init()
+        trace.sample("display", "init", describePanels(result))
+        for index, panel in enumerate(result if isinstance(result, tuple) else (result,)):
+            if panel:
+                panel.ReadRemoteCmd = recordedRead(panel.ReadRemoteCmd, index)
+        return result
+
+    def recordedRead(read, index):
+        def ReadRemoteCmd():
+            code = read()
+            if code:
+                trace.write(IR, index, code)
+            return code
+        return ReadRemoteCmd
+
+    def openDB():
+        dbi = db.DBInterface()
+        for attr in dir(dbi):
+            if attr.startswith(("load", "get")) and callable(getattr(dbi, attr)):
+                load = getattr(dbi, attr)
+                setattr(dbi, attr, lambda load=load, attr=attr: trace.sample("db", attr, load()))
+        return dbi
+
+    def watchFile(path):
+        watch = FileWatch(path)
+        changed = watch.changed
+
+        def recordedChanged():
+            if changed():
+                trace.write(WATCH, "member_config", True)
+                return True
+            return False
+        watch.changed = recordedChanged
+        return watch
+
+    class RecordedPath():
+
+        def __init__(self, path):
+            self.path = str(path)
+
+        def exists(self):
+            return trace.sample("path", f"exists {self.path}", pathlib.Path(self.path).exists())
+
+        def is_file(self):
+            return trace.sample("path", f"is_file {self.path}", pathlib.Path(self.path).is_file())
+
+    class RecordedPusher(module.EventPusher):
+
+        def send(self, body: bytes):
+            trace.write(EVENT, None, bytes(body))
+            super().send(body)
+
+    module.commands = proxyModule(commands, getoutput=getoutput)
+    module.snapshot = types.SimpleNamespace(load=loadSnapshot, save=snapshot.save)
+    module.status_board = proxyModule(status_board, StatusBoard=types.SimpleNamespace(open=openBoard))
+    module.dsp = proxyModule(display, init=initDisplay)
+    module.db = types.SimpleNamespace(DBInterface=openDB)
+    module.FileWatch = watchFile
+    module.Path = RecordedPath
+    module.which = lambda cmd: trace.sample("which", cmd, shutil.which(cmd))
+    module.EventPusher = RecordedPusher
+    return trace
+
+
+class Trace():
+    """
+    A recorded trace, indexed for lookups by virtual time
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.header = None
+        self.samples = {}
+        self.streams = collections.defaultdict(collections.deque)
+        self.walls = ([0.0], [None])
+        self.end = 0.0
+        for _, body in records(data):
+            t, channel, key, value = msgpack.unpackb(bytes(body), raw=False, strict_map_key=False)
+            self.end = max(self.end, t)
+            if channel == HEADER:
+                self.header = value
+                self.walls[1][0] = value["wall"] - value["monotonic"]
+            elif channel == WALL:
+                self.walls[0].append(t)
+                self.walls[1].append(value - self.header["monotonic"])
+            elif channel in STREAMS:
+                self.streams[(channel, key)].append((t, value))
+            else:
+                times, values = self.samples.setdefault((channel, key), ([], []))
+                times.append(t)
+                values.append(value)
+        if self.header is None:
+            raise ValueError(f"{path} is not a handler trace")
+        if self.header["version"] != TRACE_VERSION:
+            raise ValueError(f"{path} is a version {self.header['version']} trace, expected {TRACE_VERSION}")
+        self.events = list(self.streams.pop((EVENT, None), ()))
+
+
+    def value(self, channel: str, key, at: float):
+        """
+        The value recorded last at or before `at`, the first one for reads
+        the replay makes a little earlier than the recording did
+        """
+        times, values = self.samples.get((channel, key), (None, None))
+        if not times:
+            raise TraceMiss(f"The handler read {channel} {key!r}, which the trace does not have")
+        return values[max(bisect.bisect_right(times, at) - 1, 0)]
+
+
+    def next(self, channel: str, key, at: float):
+        """
+        Pops the next streamed value recorded at or before `at`, None if
+        there is none yet
+        """
+        stream = self.streams.get((channel, key))
+        if stream and stream[0][0] <= at:
+            return stream.popleft()[1]
+        return None
+
+
+    def wallAt(self, at: float) -> float:
+        """
+        Wall-clock time at `at` seconds into the recording, following the
+        recorded clock steps
+        """
+        times, offsets = self.walls
+        return offsets[bisect.bisect_right(times, at) - 1] + self.header["monotonic"] + at
+
+
+class VirtualClock():
+    """
+    `time` for the handler module, sleeping advances the clock instead
+    """
+
+    def __init__(self, trace: Trace, speed: float = 0):
+        self.trace = trace
+        self.speed = speed
+        self.t = 0.0
+        self.end = trace.end + END_MARGIN
+
+
+    def sleep(self, seconds):
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.t += seconds
+        if self.t > self.end:
+            raise ReplayDone()
+
+
+    def monotonic(self):
+        return self.trace.header["monotonic"] + self.t
+
+    perf_counter = monotonic
+
+
+    def time(self):
+        return self.trace.wallAt(self.t)
+
+
+    def now(self) -> datetime.datetime:
+        """
+        The meter's local time, independent of the replaying host's zone
+        """
+        utc = datetime.datetime.fromtimestamp(self.time(), datetime.timezone.utc)
+        return utc.replace(tzinfo=None) + datetime.timedelta(seconds=self.trace.header["utcoffset"])
+
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class ReplayPanel():
+    """
+    Display and IR receiver playing the recorded key codes back, all other
+    calls are no-ops
+    """
+
+    def __init__(self, trace: Trace, clock: VirtualClock, index: int, ids):
+        self.trace = trace
+        self.clock = clock
+        self.index = index
+        self.vid, self.pid = ids
+
+
+    def ReadRemoteCmd(self):
+        return self.trace.next(IR, self.index, self.clock.t) or 0
+
+
+    def Render(self, top, bottom, mode="viewership"):
+        return (top, bottom, mode)
+
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class ReplayDB():
+
+    viewershipConn = "viewership"
+    guestRegistrationConn = "guest_registration"
+
+    def __init__(self, trace: Trace, clock: VirtualClock):
+        self.trace = trace
+        self.clock = clock
+
+
+    def saveState(self, conn, key, value):
+        pass
+
+
+    def __getattr__(self, name):
+        return lambda: self.trace.value("db", name, self.clock.t)
+
+
+class NullNotifier():
+
+    def __init__(self, bus=None):
+        self.sent = 0
+        self.failures = 0
+        self.reconnects = 0
+
+
+    def notify(self):
+        self.sent += 1
+
+
+def installReplay(module, trace: Trace, clock: VirtualClock, workdir: str) -> list:
+    """
+    Points the handler `module` at the trace, returns the list the
+    replayed events are appended to as `(t, body)`
+    """
+    events = []
+    value = lambda channel, key: trace.value(channel, key, clock.t)
+
+    def initDisplay():
+        recorded = value("display", "init")
+        panels = tuple(ReplayPanel(trace, clock, i, ids) if ids else None for i, ids in enumerate(recorded["panels"]))
+        return panels if recorded["tuple"] else panels[0]
+
+    def openBoard(*args):
+        if not value("board", "open"):
+            return None
+        return types.SimpleNamespace(get=lambda field: value("board", field), close=lambda: None)
+
+    class ReplayPath():
+
+        def __init__(self, path):
+            self.path = str(path)
+
+        def exists(self):
+            return value("path", f"exists {self.path}")
+
+        def is_file(self):
+            return value("path", f"is_file {self.path}")
+
+    class ReplayWatch():
+
+        def __init__(self, path):
+            pass
+
+        def changed(self):
+            return bool(trace.next(WATCH, "member_config", clock.t))
+
+    class ReplayPusher(EventPusher):
+
+        def sendOne(self, body: bytes, replayed: bool = False):
+            events.append((clock.t, bytes(body)))
+            self.sent += 1
+            if self.on_sent is not None and not replayed:
+                self.on_sent(body)
+
+    virtual_datetime = type("datetime", (datetime.datetime,), {"now": classmethod(lambda cls, tz=None: clock.now())})
+    module.time = clock
+    module.datetime = proxyModule(datetime, datetime=virtual_datetime)
+    module.commands = types.SimpleNamespace(
+        getoutput=lambda cmd, name=None: value("getoutput", cmd),
+        run=lambda cmd, name=None, **kwargs: subprocess.CompletedProcess(cmd, 0, "", ""),
+        call=lambda cmd, name=None, **kwargs: 0,
+        commands=module.commands.commands,
+    )
+    module.snapshot = types.SimpleNamespace(load=lambda *args: value("snapshot", "load"), save=lambda *args: None)
+    module.status_board = proxyModule(module.status_board, StatusBoard=types.SimpleNamespace(open=openBoard))
+    module.dsp.init = initDisplay
+    module.db.DBInterface = lambda: ReplayDB(trace, clock)
+    module.FileWatch = ReplayWatch
+    module.MEMBER_CONFIG_PATH = "member_config" if trace.header["member_config"] else None
+    module.Path = ReplayPath
+    module.which = lambda cmd: value("which", cmd)
+    module.EventPusher = ReplayPusher
+    module.EventSpool = lambda: EventSpool(os.path.join(workdir, "spool"))
+    module.StateChangeNotifier = NullNotifier
+    module.MetricsWriter = lambda: MetricsWriter(os.path.join(workdir, "metrics.prom"), 0)
+    module.LoopWatchdog = lambda describe: LoopWatchdog(describe, budget=0)
+    module.MemoryTracer = lambda: MemoryTracer(os.path.join(workdir, "memtrace"), os.path.join(workdir, "memtrace.txt"))
+    module.AUDIENCE_SESSION_CLOSE_TIME = trace.header["close_time"]
+    return events
+
+
+def replay(path: str, speed: float = 0, verbose: bool = False):
+    """
+    Replays the trace at `path`, returns the trace, the replayed events
+    and the wall time the replay took
+    """
+    import fleet_sim
+
+    trace = Trace(path)
+    clock = VirtualClock(trace, speed)
+    # Read at import, the replayed events never reach it
+    os.environ.setdefault("PUSH_ADDR", os.devnull)
+    module = fleet_sim.importHandlerModule(trace.header["module"])
+    with tempfile.TemporaryDirectory(prefix="handler-replay-") as workdir:
+        events = installReplay(module, trace, clock, workdir)
+        started = time.monotonic()
+        with open(os.devnull, "w") as sink, contextlib.redirect_stdout(sys.stdout if verbose else sink):
+            try:
+                module.DisplayHandler().run()
+            except ReplayDone:
+                pass
+        elapsed = time.monotonic() - started
+    return trace, events, elapsed
+
+
+def describeEvent(body: bytes) -> str:
+    try:
+        return repr(event_codec.decodeEvent(body))
+    except event_codec.InvalidEvent:
+        return body.hex()
+
+
+def compareEvents(expected, replayed) -> str:
+    """
+    Returns a description of the first difference, None if there is none
+    """
+    for i, ((t, body), (replay_t, replay_body)) in enumerate(zip(expected, replayed)):
+        if body != replay_body:
+            return (f"Event #{i} differs\n"
+                    f"    recorded at {t:.1f}s: {describeEvent(body)}\n"
+                    f"    replayed at {replay_t:.1f}s: {describeEvent(replay_body)}")
+    if len(expected) != len(replayed):
+        longer, what = (expected, "recorded") if len(expected) > len(replayed) else (replayed, "replayed")
+        t, body = longer[min(len(expected), len(replayed))]
+        return (f"{len(expected)} events recorded, {len(replayed)} replayed, the first extra one was "
+                f"{what} at {t:.1f}s: {describeEvent(body)}")
+    return None
+
+
+def dump(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    for _, body in records(data):
+        t, channel, key, value = msgpack.unpackb(bytes(body), raw=False, strict_map_key=False)
+        if channel == EVENT:
+            value = describeEvent(value)
+        print(f"{t:12.3f} {channel:<10} {'' if key is None else key!s:<40} {value!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay or show a recorded display handler trace")
+    sub = parser.add_subparsers(dest="command", required=True)
+    replay_parser = sub.add_parser("replay", help="replay a trace and check the events")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--speed", type=float, default=0, help="times real time, 0 for as fast as possible")
+    replay_parser.add_argument("--verbose", action="store_true", help="keep the handler's own output")
+    dump_parser = sub.add_parser("dump", help="print the records of a trace")
+    dump_parser.add_argument("trace")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        dump(args.trace)
+        return
+    try:
+        trace, events, elapsed = replay(args.trace, args.speed, args.verbose)
+    except TraceMiss as e:
+        print(f"Replay diverged: {e}")
+        sys.exit(1)
+    print(f"Replayed {trace.end:.1f}s of {trace.header['module']} in {elapsed:.2f}s "
+          f"({trace.end / max(elapsed, 1e-9):.0f}x), {len(events)} events")
+    difference = compareEvents(trace.events, events)
+    if difference:
+        print(difference)
+        sys.exit(1)
+    print("Events identical to the recording")
+
+
+if __name__ == "__main__":
+    main()
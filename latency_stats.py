@@ -0,0 +1,111 @@
+"""
+Fixed-bucket latency histograms for the display handler.
+
+Histograms are keyed by `(metric, label)`, e.g. `("key_to_screen", "OK")`
+or `("serial_write", "2047:f002")`, and only hold bucket counts, so memory
+stays constant however long the handler runs. `dump()` writes them as
+JSON to `LATENCY_STATS_PATH` and prints a summary; the handler does that
+when it receives SIGUSR1.
+"""
+
+import bisect
+import json
+import os
+import time
+
+LATENCY_STATS_PATH = os.environ.get("DISPLAY_HANDLER_LATENCY_STATS", "/run/display-handler.latency")
+# Upper bounds of the buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram():
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the `q` quantile, in milliseconds
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+    def asDict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total, 3),
+            "max_ms": round(self.max, 3),
+            "buckets": {str(b): n for b, n in zip(LATENCY_BUCKETS_MS + ("inf",), self.counts)},
+        }
+
+
+class LatencyStats():
+
+    def __init__(self, path: str = LATENCY_STATS_PATH):
+        self.path = path
+        self.histograms = {}
+        self.started_at = time.time()
+        self.dump_requested = False
+
+
+    def record(self, metric: str, label: str, seconds: float):
+        histogram = self.histograms.get((metric, label))
+        if histogram is None:
+            histogram = self.histograms[(metric, label)] = Histogram()
+        histogram.add(seconds)
+
+
+    def requestDump(self, *args):
+        """
+        Signal handler, the dump itself is done by the main loop
+        """
+        self.dump_requested = True
+
+
+    def report(self) -> str:
+        lines = []
+        for (metric, label), h in sorted(self.histograms.items()):
+            lines.append(f"{metric:<14} {label:<10} n={h.count:<7} avg={h.total / h.count:.1f}ms "
+                         f"p50<={h.quantile(0.5)}ms p95<={h.quantile(0.95)}ms max={h.max:.1f}ms")
+        return "\n".join(lines)
+
+
+    def dump(self, **info):
+        """
+        Writes the histograms and `info` to the stats file and prints a
+        summary of them.
+        """
+        self.dump_requested = False
+        histograms = {}
+        for (metric, label), h in self.histograms.items():
+            histograms.setdefault(metric, {})[label] = h.asDict()
+        stats = dict(info, since=self.started_at, at=time.time(), buckets_ms=list(LATENCY_BUCKETS_MS), histograms=histograms)
+        print(self.report())
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(stats, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not write latency stats to {self.path}: {e}")
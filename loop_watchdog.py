@@ -0,0 +1,108 @@
+"""
+Watchdog for stalls of the display handler's main loop.
+
+The loop calls `beat()` once per iteration. A background thread checks
+the heartbeat and, when an iteration runs past `DISPLAY_HANDLER_LOOP_BUDGET`
+seconds, appends the handler's state and the stacks of all threads
+(via `faulthandler`) to `DISPLAY_HANDLER_STALL_LOG`. The log is rotated
+once it grows past `STALL_LOG_MAX_BYTES`, keeping `STALL_LOG_BACKUPS` old
+copies. A budget of 0 disables the watchdog, `stop()` ends it once the
+loop has exited.
+"""
+
+import datetime
+import faulthandler
+import os
+import threading
+import time
+
+LOOP_BUDGET = float(os.environ.get("DISPLAY_HANDLER_LOOP_BUDGET", 10))
+STALL_LOG_PATH = os.environ.get("DISPLAY_HANDLER_STALL_LOG", "/var/log/display-handler.stalls")
+STALL_LOG_MAX_BYTES = 512*1024
+STALL_LOG_BACKUPS = 3
+
+
+class LoopWatchdog():
+
+    def __init__(self, describe=None, budget: float = LOOP_BUDGET, path: str = STALL_LOG_PATH):
+        self.describe = describe
+        self.budget = budget
+        self.path = path
+        self.beat_at = None
+        self.reported = False
+        self.overruns = 0
+        self.max_stall = 0.0
+        self.thread = None
+        self.stopping = threading.Event()
+
+
+    def start(self):
+        if self.budget <= 0 or self.thread is not None:
+            return
+        self.beat_at = time.monotonic()
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Stops watching, for a loop that has exited
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+    def beat(self):
+        now = time.monotonic()
+        if self.reported:
+            stalled = now - self.beat_at
+            self.max_stall = max(self.max_stall, stalled)
+            print(f"Main loop iteration took {stalled:.1f}s")
+            self.reported = False
+        self.beat_at = now
+
+
+    def watch(self):
+        interval = min(self.budget / 4, 1)
+        while not self.stopping.wait(interval):
+            beat_at = self.beat_at
+            if beat_at is None or self.reported:
+                continue
+            stalled = time.monotonic() - beat_at
+            if stalled > self.budget:
+                self.reported = True
+                self.overruns += 1
+                self.report(stalled)
+
+
+    def rotate(self):
+        try:
+            if os.path.getsize(self.path) < STALL_LOG_MAX_BYTES:
+                return
+        except OSError:
+            return
+        for i in range(STALL_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i+1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+    def report(self, stalled: float):
+        print(f"Main loop stalled for {stalled:.1f}s, dumping stacks to {self.path}")
+        try:
+            self.rotate()
+            with open(self.path, "a") as f:
+                f.write(f"=== {datetime.datetime.now().isoformat()} loop stalled for {stalled:.1f}s "
+                        f"(budget {self.budget:g}s, overrun #{self.overruns})\n")
+                if self.describe is not None:
+                    try:
+                        f.write(self.describe() + "\n")
+                    except Exception as e:
+                        f.write(f"Could not describe the state: {e!r}\n")
+                f.flush()
+                faulthandler.dump_traceback(file=f, all_threads=True)
+                f.write("\n")
+        except OSError as e:
+            print(f"Could not write stall report: {e}")
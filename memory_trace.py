@@ -0,0 +1,178 @@
+"""
+On-demand `tracemalloc` snapshots for the long-running display handler.
+
+Off by default and nothing is traced until it is switched on, either by
+creating `DISPLAY_HANDLER_MEMTRACE_TRIGGER` (removing it switches it off
+again) or by sending the handler SIGRTMIN+1 (`kill -s RTMIN+1 <pid>`),
+which toggles it. While on, the main loop takes a snapshot every
+`DISPLAY_HANDLER_MEMTRACE_INTERVAL` seconds and appends the top
+allocation sites by file and line, both since the previous snapshot and
+since tracing started, to `DISPLAY_HANDLER_MEMTRACE_REPORT`.
+
+`DISPLAY_HANDLER_MEMTRACE_FRAMES` > 1 records that many frames per
+allocation and adds the tracebacks of the biggest growers to the report,
+at a higher cost.
+"""
+
+import datetime
+import os
+import time
+import tracemalloc
+
+MEMTRACE_TRIGGER = os.environ.get("DISPLAY_HANDLER_MEMTRACE_TRIGGER", "/run/display-handler.memtrace")
+MEMTRACE_REPORT = os.environ.get("DISPLAY_HANDLER_MEMTRACE_REPORT", "/var/log/display-handler.memtrace")
+MEMTRACE_INTERVAL = float(os.environ.get("DISPLAY_HANDLER_MEMTRACE_INTERVAL", 300))
+MEMTRACE_FRAMES = int(os.environ.get("DISPLAY_HANDLER_MEMTRACE_FRAMES", 1))
+MEMTRACE_TOP = int(os.environ.get("DISPLAY_HANDLER_MEMTRACE_TOP", 25))
+TRIGGER_CHECK_INTERVAL = 5
+REPORT_MAX_BYTES = 1024*1024
+TRACEBACK_SITES = 3
+
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rssBytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def formatSize(size: int) -> str:
+    sign = "-" if size < 0 else ""
+    size = abs(size)
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{sign}{size:.0f} {unit}" if unit == "B" else f"{sign}{size:.1f} {unit}"
+        size /= 1024
+    return f"{sign}{size:.1f} GiB"
+
+
+class MemoryTracer():
+
+    def __init__(self, trigger: str = MEMTRACE_TRIGGER, path: str = MEMTRACE_REPORT,
+                 interval: float = MEMTRACE_INTERVAL, frames: int = MEMTRACE_FRAMES, top: int = MEMTRACE_TOP):
+        self.trigger = trigger
+        self.path = path
+        self.interval = interval
+        self.frames = max(frames, 1)
+        self.top = top
+        self.active = False
+        self.started_tracing = False
+        self.toggle_requested = False
+        self.trigger_present = False
+        self.checked_at = 0
+        self.next_at = 0
+        self.baseline = None
+        self.previous = None
+        self.snapshots = 0
+
+
+    def requestToggle(self, *args):
+        """
+        Signal handler, the snapshots themselves are taken by the main loop
+        """
+        self.toggle_requested = True
+
+
+    def poll(self):
+        """
+        Called once per main loop iteration, cheap unless tracing is on
+        """
+        now = time.monotonic()
+        if self.toggle_requested:
+            self.toggle_requested = False
+            if self.active:
+                self.stop()
+            else:
+                self.start()
+        if now - self.checked_at >= TRIGGER_CHECK_INTERVAL:
+            self.checked_at = now
+            present = os.path.exists(self.trigger)
+            if present != self.trigger_present:
+                self.trigger_present = present
+                if present and not self.active:
+                    self.start()
+                elif not present and self.active:
+                    self.stop()
+        if self.active and now >= self.next_at:
+            self.snapshot()
+
+
+    def take(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+    def start(self):
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(self.frames)
+        self.active = True
+        self.snapshots = 0
+        self.baseline = self.previous = self.take()
+        self.next_at = time.monotonic() + self.interval
+        print(f"Memory tracing on, reporting to {self.path} every {self.interval:g}s")
+
+
+    def stop(self):
+        self.snapshot()
+        self.active = False
+        self.baseline = self.previous = None
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        print("Memory tracing off")
+
+
+    def rotate(self):
+        try:
+            if os.path.getsize(self.path) < REPORT_MAX_BYTES:
+                return
+            os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass
+
+
+    def report(self, current: tracemalloc.Snapshot) -> str:
+        traced, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"=== {datetime.datetime.now().isoformat()} snapshot #{self.snapshots}: "
+            f"rss {formatSize(rssBytes())}, traced {formatSize(traced)} (peak {formatSize(peak)}), "
+            f"tracemalloc overhead {formatSize(tracemalloc.get_tracemalloc_memory())}",
+        ]
+
+        def section(title, stats):
+            lines.append(f"--- {title}")
+            for stat in stats[:self.top]:
+                frame = stat.traceback[0]
+                lines.append(f"{formatSize(stat.size_diff):>12} {stat.count_diff:+8d} blocks "
+                             f"{formatSize(stat.size):>12} now  {frame.filename}:{frame.lineno}")
+
+        section("Since the previous snapshot", current.compare_to(self.previous, "lineno"))
+        section("Since tracing started", current.compare_to(self.baseline, "lineno"))
+        if self.frames > 1:
+            by_traceback = current.compare_to(self.baseline, "traceback")
+            for stat in by_traceback[:TRACEBACK_SITES]:
+                lines.append(f"--- {formatSize(stat.size_diff)} grown at")
+                lines.extend(stat.traceback.format())
+        return "\n".join(lines) + "\n\n"
+
+
+    def snapshot(self):
+        current = self.take()
+        self.snapshots += 1
+        self.next_at = time.monotonic() + self.interval
+        try:
+            text = self.report(current)
+            self.rotate()
+            with open(self.path, "a") as f:
+                f.write(text)
+        except OSError as e:
+            print(f"Could not write memory report to {self.path}: {e}")
+        self.previous = current
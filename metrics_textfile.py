@@ -0,0 +1,109 @@
+"""
+Prometheus metrics written to a node_exporter textfile.
+
+The handler fills a `MetricsWriter` with counter/gauge/histogram families
+every `DISPLAY_HANDLER_METRICS_INTERVAL` seconds and `write()` replaces
+`DISPLAY_HANDLER_METRICS_PATH` atomically, so the collector never reads a
+half written file. Metric names are prefixed with `display_handler_`.
+"""
+
+import os
+import time
+
+from latency_stats import LATENCY_BUCKETS_MS
+
+METRICS_PATH = os.environ.get("DISPLAY_HANDLER_METRICS_PATH", "/var/lib/node_exporter/textfile_collector/display_handler.prom")
+METRICS_INTERVAL = float(os.environ.get("DISPLAY_HANDLER_METRICS_INTERVAL", 15))
+METRICS_PREFIX = "display_handler_"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatLabels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def formatValue(value) -> str:
+    """
+    Ints (counters) are written exactly, floats with all their digits
+    """
+    if isinstance(value, (bool, int)):
+        return str(int(value))
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class MetricsWriter():
+
+    def __init__(self, path: str = METRICS_PATH, interval: float = METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.next_at = 0
+        self.lines = []
+        self.writes = 0
+        self.failing = False
+
+
+    def due(self) -> bool:
+        return self.interval > 0 and time.monotonic() >= self.next_at
+
+
+    def family(self, name: str, kind: str, help: str):
+        self.lines.append(f"# HELP {METRICS_PREFIX}{name} {help}")
+        self.lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+
+    def sample(self, name: str, value, labels: dict = None):
+        self.lines.append(f"{METRICS_PREFIX}{name}{formatLabels(labels)} {formatValue(value)}")
+
+
+    def metric(self, name: str, kind: str, help: str, value, labels: dict = None):
+        """
+        Adds a family with a single sample
+        """
+        self.family(name, kind, help)
+        self.sample(name, value, labels)
+
+
+    def histograms(self, name: str, help: str, histograms):
+        """
+        Adds `latency_stats.Histogram`s as one Prometheus histogram family in
+        seconds, `histograms` yields `(labels, histogram)`.
+        """
+        self.family(name, "histogram", help)
+        for labels, h in histograms:
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS_MS, h.counts):
+                cumulative += n
+                self.sample(f"{name}_bucket", cumulative, dict(labels, le=f"{bound / 1000:g}"))
+            self.sample(f"{name}_bucket", h.count, dict(labels, le="+Inf"))
+            self.sample(f"{name}_sum", h.total / 1000, labels)
+            self.sample(f"{name}_count", h.count, labels)
+
+
+    def write(self):
+        """
+        Atomically replaces the textfile with the collected families
+        """
+        lines, self.lines = self.lines, []
+        self.next_at = time.monotonic() + self.interval
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            if not self.failing:
+                print(f"Could not write metrics to {self.path}: {e}")
+                self.failing = True
+            return
+        self.failing = False
+        self.writes += 1
@@ -0,0 +1,93 @@
+"""
+Level-gated logging with deferred formatting and an in-memory ring.
+
+Every record is appended to a ring of the last `DISPLAY_HANDLER_LOG_RING`
+records as `(time, level, msg, args)` and only formatted with `msg % args`
+when it is printed (level at or above `level`) or when the ring is dumped.
+So a debug record on the hot path costs a tuple and a deque append. Pass
+values rather than objects that change afterwards, the ring formats them
+late.
+
+`error()` also dumps the ring to `DISPLAY_HANDLER_LOG_DUMP`, at most once
+every `DUMP_INTERVAL` seconds; `dump()` can be called from a signal driven
+path as well.
+"""
+
+import collections
+import os
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+RING_SIZE = int(os.environ.get("DISPLAY_HANDLER_LOG_RING", 2000))
+DUMP_PATH = os.environ.get("DISPLAY_HANDLER_LOG_DUMP", "/run/display-handler.log")
+DUMP_INTERVAL = 60
+
+level = {v: k for k, v in LEVEL_NAMES.items()}.get(os.environ.get("DISPLAY_HANDLER_LOG_LEVEL", "INFO").upper(), INFO)
+ring = collections.deque(maxlen=RING_SIZE)
+last_dump_at = None
+
+
+def setLevel(new_level: int):
+    global level
+    level = new_level
+
+
+def enabled(at_level: int) -> bool:
+    return at_level >= level
+
+
+def formatMessage(msg, args) -> str:
+    if not args:
+        return str(msg)
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return f"{msg} {args!r}"
+
+
+def debug(msg, *args):
+    ring.append((time.time(), DEBUG, msg, args))
+    if level <= DEBUG:
+        print(formatMessage(msg, args))
+
+
+def info(msg, *args):
+    ring.append((time.time(), INFO, msg, args))
+    if level <= INFO:
+        print(formatMessage(msg, args))
+
+
+def warning(msg, *args):
+    ring.append((time.time(), WARNING, msg, args))
+    if level <= WARNING:
+        print(formatMessage(msg, args))
+
+
+def error(msg, *args):
+    global last_dump_at
+    ring.append((time.time(), ERROR, msg, args))
+    print(formatMessage(msg, args))
+    if last_dump_at is None or time.monotonic() - last_dump_at > DUMP_INTERVAL:
+        last_dump_at = time.monotonic()
+        dump()
+
+
+def dump(path: str = None):
+    """
+    Writes the ring, oldest record first, to `path`
+    """
+    path = path or DUMP_PATH
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            for at, record_level, msg, args in list(ring):
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(at))
+                f.write(f"{stamp}.{int(at % 1 * 1000):03d} {LEVEL_NAMES[record_level]:<7} {formatMessage(msg, args)}\n")
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not dump the log ring to {path}: {e}")
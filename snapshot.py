@@ -0,0 +1,39 @@
+"""
+Versioned msgpack snapshot of the display handler state.
+
+The snapshot is a cache of what the DBs and `get_config` hold, written after
+every state save so that a restarted handler can paint the right screen
+from a single read before it goes back to the slower sources.
+"""
+
+import os
+
+import msgpack
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = os.environ.get("DISPLAY_HANDLER_SNAPSHOT", "/var/data/display-handler.snapshot")
+
+
+def save(state: dict, path: str = SNAPSHOT_PATH):
+    """
+    Atomically replaces the snapshot at `path` with `state`
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(msgpack.packb([SNAPSHOT_VERSION, state]))
+    os.replace(tmp, path)
+
+
+def load(path: str = SNAPSHOT_PATH):
+    """
+    Returns the snapshotted state, `None` if it is missing, unreadable or
+    from another snapshot version.
+    """
+    try:
+        with open(path, "rb") as f:
+            version, state = msgpack.unpackb(f.read())
+    except Exception:
+        return None
+    if version != SNAPSHOT_VERSION or not isinstance(state, dict):
+        return None
+    return state
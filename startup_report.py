@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""
+Startup timing of the display handler, from `-X importtime`.
+
+    startup_report.py [--main state] [--pyz PATH] [--runs N] [--top N] [--cold]
+
+Every run starts a fresh interpreter that only imports the handler module,
+from this directory or from a zipapp built by build_zipapp.py (`--pyz`),
+and reports the wall time of the whole process and the import time of
+each module. The summary gives the medians over the runs, the import time
+per top-level package (PIL, serial, msgpack, the handler's own modules,
+...) and the slowest modules by their own import time.
+
+`--cold` syncs and drops the page cache before every run (as root), so
+the interpreter, the standard library and the handler are read from the
+storage again as on boot; without it the runs are warm. Run it with the
+service's environment, `PUSH_ADDR` defaults to /dev/null.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DROP_CACHES = "/proc/sys/vm/drop_caches"
+
+
+def parseImportTime(stderr: str) -> list:
+    """
+    Returns (name, self us, cumulative us) per imported module
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def dropCaches():
+    os.sync()
+    with open(DROP_CACHES, "w") as f:
+        f.write("3\n")
+
+
+def run(main: str, pyz: str = None, cold: bool = False) -> tuple:
+    """
+    Returns the wall time in us of one interpreter importing `main` and
+    its `-X importtime` rows
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.setdefault("PUSH_ADDR", os.devnull)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (pyz or here, env.get("PYTHONPATH")) if p)
+    if cold:
+        dropCaches()
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {main}"],
+                            env=env, cwd=os.sep, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall_us = (time.perf_counter() - start) * 1e6
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {main} failed:\n{result.stderr[-2000:]}")
+    return wall_us, parseImportTime(result.stderr)
+
+
+def summarize(runs: list, top: int) -> str:
+    walls = [wall for wall, rows in runs]
+    imports = [sum(self_us for name, self_us, cumulative_us in rows) for wall, rows in runs]
+    packages = [{} for _ in runs]
+    modules = [{} for _ in runs]
+    for (wall, rows), run_packages, run_modules in zip(runs, packages, modules):
+        for name, self_us, cumulative_us in rows:
+            package = name.split(".")[0]
+            run_packages[package] = run_packages.get(package, 0) + self_us
+            run_modules[name] = self_us
+
+    def medians(per_run: list) -> list:
+        # a name missing from a run counts as 0 there
+        names = set().union(*per_run)
+        return sorted(((statistics.median(r.get(name, 0) for r in per_run), name) for name in names), reverse=True)
+
+    by_package = medians(packages)
+    by_module = medians(modules)
+    lines = [
+        f"runs: {len(runs)}",
+        f"process wall time: median {statistics.median(walls) / 1000:.1f} ms, min {min(walls) / 1000:.1f} ms",
+        f"imports: median {statistics.median(imports) / 1000:.1f} ms over {len(by_module)} modules",
+        "",
+        f"{'package':<28} {'ms':>8}",
+    ]
+    lines += [f"{name:<28} {us / 1000:>8.2f}" for us, name in by_package[:top]]
+    lines += ["", f"{'module':<28} {'self ms':>8}"]
+    lines += [f"{name:<28} {us / 1000:>8.2f}" for us, name in by_module[:top]]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup timing of the display handler")
+    parser.add_argument("--main", default="state", help="handler module, state or state_dual")
+    parser.add_argument("--pyz", help="time the handler from this zipapp")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--cold", action="store_true", help=f"drop the page cache before every run, needs {DROP_CACHES}")
+    args = parser.parse_args()
+
+    pyz = os.path.abspath(args.pyz) if args.pyz else None
+    try:
+        runs = [run(args.main, pyz, args.cold) for _ in range(args.runs)]
+    except (OSError, RuntimeError) as e:
+        print(e)
+        sys.exit(1)
+    print(f"{args.main} from {pyz or 'sources'}, {'cold' if args.cold else 'warm'} page cache")
+    print(summarize(runs, args.top))
+
+
+if __name__ == "__main__":
+    main()
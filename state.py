@@ -1,22 +1,34 @@
-import copy
 import datetime
 import json
-import msgpack
 import os
 from pathlib import Path
-import subprocess
-import socket
+import signal
 from shutil import which
+import sys
 import time
+import traceback
 
+import commands
+import ring_log as log
+from config_watch import FileWatch
 import db
+import event_codec
+import handler_trace
+from event_push import EventPusher
+from event_spool import EventSpool
+from latency_stats import LatencyStats
+from loop_watchdog import LoopWatchdog
+from memory_trace import MemoryTracer, rssBytes
+from metrics_textfile import MetricsWriter
+import snapshot
+import status_board
+from trace_spans import traced, tracer
+from dbus_notify import StateChangeNotifier
 import display as dsp
 
-EVENT_VERSION = 1
-EVENT_TYPE_GUEST_REG = 2
-EVENT_TYPE_MEM_GUEST_DECL = 3
-EVENT_TYPE_REMOTE_ACTIVITY = 25
 INSTALLATION_MODE_SENTINEL = "/run/installation_mode"
+# File backing `get_config MEMBER_INFO`, watched for household edits
+MEMBER_CONFIG_PATH = os.environ.get("MEMBER_CONFIG_PATH")
 
 # get the socket file
 socket_address = os.environ['PUSH_ADDR']
@@ -29,20 +41,59 @@ class InvalidRC5Command(RuntimeError):
     pass
 
 
-VERBOSE = False
 DISPLAY_TIMEOUT=20
 INFO_REFRESH_TIMEOUT=5
 GREG_KP_TIMEOUT=20
 MAX_ALLOWED_BRIGHTNESS=255
 MIN_ALLOWED_BRIGHTNESS=1
 BRIGHTNESS_LEVEL_STEP=20
+STATUS_BOARD_RETRY=30
 
-def dprint(msg: str):
-    if VERBOSE:
-        print(msg)
+# Viewer bit layout: members A-L are bits 0-11, guests G1-G5 are bits 12-16
+MEMBER_COUNT = 12
+GUEST_COUNT = 5
+MEMBERS_MASK = (1 << MEMBER_COUNT) - 1
+GUESTS_MASK = ((1 << GUEST_COUNT) - 1) << MEMBER_COUNT
+VIEWER_KEYS = [chr(65+i) for i in range(MEMBER_COUNT)] + ["G"+str(i) for i in range(1, GUEST_COUNT+1)]
+VIEWER_BITS = {v: 1 << i for i, v in enumerate(VIEWER_KEYS)}
+
+# Panel row glyphs, indexed by viewer bit
+ROW_LABELS = b"ABCDEFGHIJKL12345"
+ROW_UNREGISTERED = ord(".")
+ROW_UNDECLARED = ord("_")
+ROW_FREE_SLOT = ord("*")
+ROW_BLANK = ord(" ")
+ROW_ABSENT = ord("1")
+ROW_PRESENT = ord("0")
+ROW_GUEST_FLOW = ord(";")
+
+def guestBit(position) -> int:
+    return 1 << (MEMBER_COUNT + int(position) - 1)
+
+
+def maskToViewers(mask: int):
+    """
+    Expand a viewer mask into the sorted key list persisted in the DB
+    """
+    return sorted(v for v, b in VIEWER_BITS.items() if mask & b)
+
+
+class ViewersOf():
+    """
+    Log argument that expands a viewer mask only when the record is formatted
+    """
+    __slots__ = ("mask",)
+
+    def __init__(self, mask: int):
+        self.mask = mask
+
+
+    def __str__(self):
+        return str(maskToViewers(self.mask))
 
 
 class Guest():
+    __slots__ = ("position", "identity")
 
     def __init__(self, position, identity=None):
         self.position = str(position)
@@ -53,12 +104,117 @@ class Guest():
         return f"(G{self.position}, {self.identity})"
 
 
-class State():
+class GuestTable():
+    """
+    Registered guests kept in fixed slots indexed by `position - 1`
+    """
+    __slots__ = ("slots", "mask")
 
     def __init__(self):
-        self.viewersDeclared = []
+        self.slots = [None]*GUEST_COUNT
+        self.mask = 0
+
+
+    def __iter__(self):
+        for g in self.slots:
+            if g is not None:
+                yield g
+
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+    def get(self, position):
+        """
+        Returns the guest registered at `position`, `None` if the slot is free
+        """
+        try:
+            i = int(position)-1
+        except ValueError:
+            return None
+        if 0 <= i < GUEST_COUNT:
+            return self.slots[i]
+        return None
+
+
+    def add(self, guest: Guest) -> bool:
+        """
+        Puts `guest` in its slot, returns False and skips it if its
+        position is not one of 1-GUEST_COUNT
+        """
+        try:
+            i = int(guest.position)-1
+        except ValueError:
+            i = -1
+        if not 0 <= i < GUEST_COUNT:
+            log.warning("Skipping guest %s at invalid position %r", guest.identity, guest.position)
+            return False
+        self.slots[i] = guest
+        self.mask |= guestBit(guest.position)
+        return True
+
+
+    def clear(self):
+        self.slots = [None]*GUEST_COUNT
+        self.mask = 0
+
+
+class WriteStats():
+    """
+    Per-day and total counts of the fields, payload bytes and commits of
+    `saveState`, which commits at most once per DB connection it writes to
+    """
+
+    def __init__(self):
+        self.day = datetime.date.today()
+        self.writes = 0
+        self.bytes = 0
+        self.commits = 0
+        self.writes_total = 0
+        self.bytes_total = 0
+        self.commits_total = 0
+
+
+    @staticmethod
+    def payloadSize(data) -> int:
+        return 0 if data is None else len(str(data).encode())
+
+
+    def rollover(self):
+        """
+        Logs and restarts the daily counts once the day has changed
+        """
+        today = datetime.date.today()
+        if today != self.day:
+            log.info("DB writes on %s: %d fields, %d bytes, %d commits", self.day, self.writes, self.bytes, self.commits)
+            self.day = today
+            self.writes = 0
+            self.bytes = 0
+            self.commits = 0
+
+
+    def record(self, writes: int, size: int, commits: int):
+        self.rollover()
+        self.writes += writes
+        self.bytes += size
+        self.commits += commits
+        self.writes_total += writes
+        self.bytes_total += size
+        self.commits_total += commits
+
+
+class State():
+
+    def __init__(self, is_bm3=None):
+        self.declaredMask = 0
+        self.memberMask = 0
         self.viewersRegistered = []
-        self.guestsRegistered = []
+        self.guestsRegistered = GuestTable()
         self.absent = None
         self.cleared_aud = None
         self.grKeyPressTime = None
@@ -73,9 +229,41 @@ class State():
         self.brightnessLevel = 255
         self.in_installation_mode = False
         self.remote_paired = False
-        self.is_bm3 = 40000000 > int(subprocess.getoutput("meter_id")) >= 30000000
+        if is_bm3 is None:
+            is_bm3 = 40000000 > int(commands.getoutput("meter_id")) >= 30000000
+        self.is_bm3 = is_bm3
         self.infoFlag = False
 
+    @property
+    def viewersRegistered(self):
+        return self._viewersRegistered
+
+    @viewersRegistered.setter
+    def viewersRegistered(self, regs):
+        self._viewersRegistered = regs
+        self.memberMask = 0
+        for v in regs:
+            self.memberMask |= VIEWER_BITS.get(v, 0) & MEMBERS_MASK
+
+    @property
+    def guestMask(self):
+        return self.guestsRegistered.mask
+
+    @property
+    def registeredMask(self):
+        return self.memberMask | self.guestMask
+
+    @property
+    def absentMask(self):
+        """
+        Registered viewers that are not declared, shown as `_` on the panel
+        """
+        return self.registeredMask & ~self.declaredMask
+
+    @property
+    def viewersDeclared(self):
+        return maskToViewers(self.declaredMask)
+
 class Remote(State):
 
     def declareStateVars(self):
@@ -142,24 +330,21 @@ class Remote(State):
         """
         Get registered guests from DB.
         """
-        self.guestsRegistered = []
+        self.guestsRegistered.clear()
         gr = self.dbi.loadGuestRegistration()
         for g in gr:
-            self.guestsRegistered.append(Guest(g[0], g[1]))
+            self.guestsRegistered.add(Guest(g[0], g[1]))
 
 
     def loadDeclaration(self):
         """
         Get declared viewers from DB
         """
-        self.viewersDeclared = []
+        self.declaredMask = 0
+        registered = self.registeredMask
         vd = self.dbi.loadDeclaration()
         for v in vd:
-            if len(v) == 1 and v in self.viewersRegistered:
-                self.viewersDeclared.append(v)
-            elif len(v) == 2 and self.guest_reg(Guest(v[1:])):
-                self.viewersDeclared.append(v)
-        self.viewersDeclared.sort()
+            self.declaredMask |= VIEWER_BITS.get(v, 0) & registered
 
 
     def defaultRegMembers(self):
@@ -175,7 +360,7 @@ class Remote(State):
         """
 
         regs = []
-        member_info = subprocess.getoutput('get_config MEMBER_INFO')
+        member_info = commands.getoutput('get_config MEMBER_INFO')
         if not member_info:
             if self.in_installation_mode:
                 return self.defaultRegMembers() 
@@ -192,66 +377,215 @@ class Remote(State):
         return regs
 
 
-    def __init__(self):
-        super().__init__()
-        self.declareStateVars()
-        self.declareKeyMaps()
-        self.dbi = db.DBInterface()
+    def loadStoredState(self):
+        """
+        Loads the persisted state from the DBs and the member config
+        """
         self.cleared_aud = self.dbi.loadClearedAud()
+        # readMemberConfig falls back to the default members in installation mode
+        self.in_installation_mode = self.dbi.loadInstallationModeState()
         self.viewersRegistered  = self.readMemberConfig()
         self.loadGuestRegistration()
         self.loadDeclaration()
         self.absent = self.dbi.getAbsentStatus()
         self.tv = self.dbi.loadTVState()
-        self.validKeys = self.KeyToNum.keys()
-        self.lastCommState = State()
         self.brightnessLevel = self.dbi.loadBrightnessLevel()
-        self.in_installation_mode = self.dbi.loadInstallationModeState()
+
+
+    def snapshotState(self) -> dict:
+        return {
+            "is_bm3": self.is_bm3,
+            "cleared_aud": self.cleared_aud,
+            "registered": list(self.viewersRegistered),
+            "guests": [[g.position, g.identity] for g in self.guestsRegistered],
+            "declared": self.declaredMask,
+            "absent": bool(self.absent),
+            "tv": bool(self.tv),
+            "brightness": int(self.brightnessLevel),
+            "installation": bool(self.in_installation_mode),
+        }
+
+
+    def applySnapshot(self, snap: dict) -> bool:
+        """
+        Restores the state from a snapshot, returns False if it is malformed
+        """
+        try:
+            self.cleared_aud = snap["cleared_aud"]
+            self.viewersRegistered = list(snap["registered"])
+            self.guestsRegistered.clear()
+            for position, identity in snap["guests"]:
+                self.guestsRegistered.add(Guest(position, identity))
+            self.declaredMask = snap["declared"] & self.registeredMask
+            self.absent = snap["absent"]
+            self.tv = snap["tv"]
+            self.brightnessLevel = snap["brightness"]
+            self.in_installation_mode = snap["installation"]
+        except (KeyError, TypeError, ValueError, IndexError):
+            return False
+        return True
+
+
+    def saveSnapshot(self):
+        try:
+            snapshot.save(self.snapshotState())
+        except OSError as e:
+            log.debug("Could not write state snapshot: %s", e)
+
+
+    def validateSnapshot(self) -> bool:
+        """
+        Reloads the state from its sources after a warm start and keeps
+        the sources' version, returns True if the snapshot was stale.
+        """
+        cached = self.snapshotState()
+        self.loadStoredState()
+        self.warmStarted = False
+        if self.snapshotState() == cached:
+            return False
+        print("State snapshot was stale, reloaded from DB")
+        self.saveSnapshot()
+        return True
+
+
+    def __init__(self):
+        snap = snapshot.load()
+        super().__init__(snap.get("is_bm3") if snap else None)
+        self.declareStateVars()
+        self.declareKeyMaps()
+        self.dbi = db.DBInterface()
+        # Last values written per DB key, used to skip unchanged fields
+        self.persisted = {}
+        self.writeStats = WriteStats()
+        self.notifier = StateChangeNotifier()
+        self.latency = LatencyStats()
+        # (key, read at) of the last key press until it reached the screen / an event
+        self.keyScreenPending = None
+        self.keyEventPending = None
+        # Events the consumer could not take are spooled and replayed in order
+        self.eventBackpressure = False
+        self.pusher = EventPusher(socket_address, spool=self.openEventSpool(),
+                                  on_backpressure=self.onEventBackpressure, on_sent=self.onEventSent)
+        self.statusBoard = None
+        self.statusBoardRetryAt = 0
+        # On a warm start the DB is only consulted once the first screen is up
+        self.warmStarted = bool(snap) and self.applySnapshot(snap)
+        if not self.warmStarted:
+            self.loadStoredState()
+        self.validKeys = self.KeyToNum.keys()
+        self.lastCommState = State(self.is_bm3)
         self.refreshed_info_at = None
         self.last_known_key_press = None
 
 
     def dbusNotify(self):
-        subprocess.call(
-            "dbus-send --system /in/fluctus/baro3/DisplayHandler in.fluctus.baro3.DisplayHandler.StateChange",
-            shell=True
+        self.notifier.notify()
+
+
+    def openEventSpool(self):
+        """
+        Returns the event spool, None if it cannot be opened; the handler
+        then runs without one and drops the events the consumer misses
+        """
+        try:
+            return EventSpool()
+        except OSError as e:
+            log.warning("Event spool unavailable, undelivered events will be dropped: %s", e)
+            return None
+
+
+    def onEventBackpressure(self, congested: bool):
+        spool = self.pusher.spool
+        if congested:
+            log.warning("Event consumer backlog: %d events, %d of %d spool bytes", spool.pending, spool.size, spool.max_bytes)
+        else:
+            log.info("Event consumer backlog cleared, %d events dropped so far", spool.dropped)
+        self.eventBackpressure = congested
+
+
+    def onEventSent(self, body):
+        if self.keyEventPending is not None:
+            key, at = self.keyEventPending
+            self.latency.record("key_to_event", key, time.monotonic() - at)
+            self.keyEventPending = None
+
+
+    def persistedFields(self):
+        """
+        Returns `(conn, key, value)` for every persisted state field, where
+        `value` is the cheap in-memory form used for dirty checks.
+        """
+        return (
+            (self.dbi.viewershipConn, 'declared_viewers', self.declaredMask),
+            (self.dbi.viewershipConn, 'last_known_tv_state', bool(self.tv)),
+            (self.dbi.guestRegistrationConn, 'guests_registered', tuple((g.position, g.identity) for g in self.guestsRegistered)),
+            (self.dbi.guestRegistrationConn, 'cleared_for_aud', self.cleared_aud),
+            (self.dbi.guestRegistrationConn, 'absent', bool(self.absent)),
+            (self.dbi.guestRegistrationConn, 'brightness_level', self.brightnessLevel),
+            (self.dbi.guestRegistrationConn, 'in_installation_mode', self.in_installation_mode),
         )
 
 
+    def encodeField(self, key, value):
+        """
+        Serializes a field exactly as it has always been stored in the DB
+        """
+        if key == 'declared_viewers':
+            return json.dumps(maskToViewers(value))
+        elif key == 'guests_registered':
+            return json.dumps([list(g) for g in value])
+        elif key in ('last_known_tv_state', 'absent'):
+            return int(value)
+        elif key in ('brightness_level', 'in_installation_mode'):
+            return str(value)
+        return value
+
+
+    @traced("saveState")
     def saveState(self):
+        """
+        Writes the fields that changed since the last save, one
+        `DBInterface.saveState` call per field.
+        """
         self.dprintStates("Saving states")
-        self.dbi.saveState(self.dbi.viewershipConn, 'declared_viewers', json.dumps(self.viewersDeclared))
-        self.dbi.saveState(self.dbi.viewershipConn, 'last_known_tv_state', int(self.tv))
-        self.dbi.saveState(self.dbi.guestRegistrationConn, 'guests_registered', json.dumps([(g.position, g.identity) for g in self.guestsRegistered]))
-        self.dbi.saveState(self.dbi.guestRegistrationConn, 'cleared_for_aud', self.cleared_aud)
-        self.dbi.saveState(self.dbi.guestRegistrationConn, 'absent', int(self.absent))
-        self.dbi.saveState(self.dbi.guestRegistrationConn, 'brightness_level', str(self.brightnessLevel))
-        self.dbi.saveState(self.dbi.guestRegistrationConn, 'in_installation_mode', str(self.in_installation_mode))
+        conns = set()
+        writes = 0
+        size = 0
+        for conn, key, value in self.persistedFields():
+            if key in self.persisted and self.persisted[key] == value:
+                continue
+            data = self.encodeField(key, value)
+            self.dbi.saveState(conn, key, data)
+            self.persisted[key] = value
+            writes += 1
+            size += WriteStats.payloadSize(data)
+            conns.add(conn)
+        if writes:
+            self.writeStats.record(writes, size, len(conns))
+            self.saveSnapshot()
         self.dbusNotify()
         self.stateChangedAt=None
 
 
     def clearViewership(self):
-        dprint("Clearing viewership")
-        self.viewersDeclared = []
+        log.debug("Clearing viewership")
+        self.declaredMask = 0
         self.saveState()
 
 
     def clearGuestRegistration(self):
-        dprint("Deregistering guests")
-        for g in self.guestsRegistered:
-            if "G"+g.position in self.viewersDeclared:
-                self.viewersDeclared.remove("G"+g.position)
-        self.viewersDeclared.sort()
-        self.pushEvent()
-        for g in self.guestsRegistered:
-            self.pushEvent(deReg=g)
-        self.guestsRegistered = []
+        log.debug("Deregistering guests")
+        self.declaredMask &= ~self.guestMask
+        with self.pusher.batch():
+            self.pushEvent()
+            for g in self.guestsRegistered:
+                self.pushEvent(deReg=g)
+        self.guestsRegistered.clear()
         self.saveState()
 
 
     def moveToTVON(self):
-        dprint("On TV ON ...")
+        log.debug("On TV ON ...")
         self.tv = True
         self.checkEventGen(True)
         self.clearViewership()
@@ -262,13 +596,13 @@ class Remote(State):
     def clearUserPresence(self):
         if self.absent:
             self.absent = not self.absent
-        self.guestsRegistered = []
+        self.guestsRegistered.clear()
 
 
     def moveToInstallationMode(self):
         if not self.is_bm3:
             self.close()
-        dprint("In installation mode ...")
+        log.debug("In installation mode ...")
         self.in_installation_mode = True
         # For old states since 20s buffer
         self.checkEventGen(True)
@@ -278,10 +612,10 @@ class Remote(State):
 
 
     def moveOutInstallationMode(self):
-        dprint("Moving out of installation mode ...")
+        log.debug("Moving out of installation mode ...")
         if not self.is_bm3:
             timer=60
-            dprint(f"Waiting for {timer}s ...")
+            log.debug("Waiting for %ss ...", timer)
             time.sleep(timer)
             if self.checkInstallationMode():
                 return
@@ -294,7 +628,7 @@ class Remote(State):
 
 
     def onTVOFF(self):
-        dprint("On TV OFF ..")
+        log.debug("On TV OFF ..")
         self.tv = False
         self.checkEventGen(True)
         self.clearViewership()
@@ -310,67 +644,35 @@ class Remote(State):
             self.saveState()
 
 
-    def guest_reg(self, guest: Guest):
-        dprint(f"Check guest {guest.position} registered?")
-        for g in self.guestsRegistered:
-            if guest.position == g.position:
-                return g
-        return False
-
-
     def sendEvent(self, body):
-        push_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        push_socket.connect(socket_address)
-        push_socket.sendall(body)
-        push_socket.close()
+        self.pusher.send(body)
 
 
+    @traced("pushEvent")
     def pushEvent(self, toBeRegisteredGuest=None, deReg=None):
         if toBeRegisteredGuest:
             # Registeration
-            guest_id = int(toBeRegisteredGuest.position)-1
-            guest_age = int(toBeRegisteredGuest.identity[1:])
-            body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_GUEST_REG)+\
-                msgpack.packb({"Guest_id": guest_id, "Registering": True, \
-                               "Guest_age": guest_age, \
-                               "Guest_male":toBeRegisteredGuest.identity[0]=="M"})
-            dprint("Guest reg event body: ")
-            dprint({"Guest_id": guest_id, "Registering": True, \
-                           "Guest_age": guest_age, \
-                           "Guest_male":toBeRegisteredGuest.identity[0]=="M"})
+            body = event_codec.guestRegistrationEvent(int(toBeRegisteredGuest.position)-1, True,
+                                                      int(toBeRegisteredGuest.identity[1:]),
+                                                      toBeRegisteredGuest.identity[0]=="M")
+            log.debug("Guest reg event for: G%s %s", toBeRegisteredGuest.position, toBeRegisteredGuest.identity)
         elif deReg:
             # Guest De-Reg
-            guest_id = int(deReg.position)-1
-            guest_age = int(deReg.identity[1:])
-            body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_GUEST_REG)+\
-                msgpack.packb({"Guest_id": guest_id, "Registering": False, \
-                            "Guest_age": guest_age, \
-                            "Guest_male":deReg.identity[0]=="M"})
-            dprint("Guest de-reg event body: ")
-            dprint({"Guest_id": guest_id, "Registering": False, \
-                        "Guest_age": guest_age, \
-                        "Guest_male":deReg.identity[0]=="M"})
+            body = event_codec.guestRegistrationEvent(int(deReg.position)-1, False,
+                                                      int(deReg.identity[1:]),
+                                                      deReg.identity[0]=="M")
+            log.debug("Guest de-reg event for: G%s %s", deReg.position, deReg.identity)
         else:
             # Declaration
-            if self.lastCommState.viewersDeclared != self.viewersDeclared:
-                member_keys = [False]*12
-                guest_keys = [False]*5
-                for m in self.viewersDeclared:
-                    if len(m) == 1:
-                        member_keys[ord(m)-65] = True
-                    elif len(m) == 2:
-                        guest_keys[int(m[1:])-1] = True
-                body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_MEM_GUEST_DECL)+\
-                    msgpack.packb({"Member_Keys": member_keys, "Guests": guest_keys, "Confidence": 100})
-                dprint("Mem declaration event body: ")
-                dprint({"Member_Keys": member_keys, "Guests": guest_keys, "Confidence": 100})
+            if self.lastCommState.declaredMask != self.declaredMask:
+                declared = self.declaredMask
+                body = event_codec.declarationEvent(declared & MEMBERS_MASK, declared >> MEMBER_COUNT)
+                log.debug("Mem declaration event for: %s", ViewersOf(declared))
                 self.sendEvent(body)
-                self.lastCommState.viewersDeclared = copy.deepcopy(self.viewersDeclared)
+                self.lastCommState.declaredMask = declared
             if self.lastCommState.absent != self.absent:
-                body = msgpack.packb(EVENT_VERSION)+msgpack.packb(EVENT_TYPE_REMOTE_ACTIVITY)+\
-                    msgpack.packb({"Lock": False, "ORR": False, "Absent_Key_Press": self.absent, "Drop": False})
-                dprint("Remote state event body: ")
-                dprint({"Lock": False, "ORR": False, "Absent_Key_Press": self.absent, "Drop": False})
+                body = event_codec.remoteActivityEvent(self.absent)
+                log.debug("Remote state event, absent: %s", self.absent)
                 self.sendEvent(body)
                 self.lastCommState.absent = self.absent
             return
@@ -380,15 +682,44 @@ class Remote(State):
     def checkEventGen(self, force: bool=False):
         if (self.stateChangedAt and datetime.datetime.now() - self.stateChangedAt > datetime.timedelta(seconds=20)) or force:
             self.saveState()
-            self.pushEvent()
+            with self.pusher.batch():
+                self.pushEvent()
+
+
+    def boardValue(self, field: int):
+        """
+        Returns a field of the shared status board, `None` if no producer
+        publishes it and the caller has to query the source itself.
+        """
+        if self.statusBoard is None:
+            if time.monotonic() < self.statusBoardRetryAt:
+                return None
+            self.statusBoard = status_board.StatusBoard.open()
+            if self.statusBoard is None:
+                self.statusBoardRetryAt = time.monotonic() + STATUS_BOARD_RETRY
+                return None
+        return self.statusBoard.get(field)
 
 
     def checkInstallationMode(self):
+        in_installation_mode = self.boardValue(status_board.INSTALLATION_MODE)
+        if in_installation_mode is not None:
+            return bool(in_installation_mode)
         return Path(INSTALLATION_MODE_SENTINEL).exists()
 
 
     def dprintStates(self, where: str):
-        dprint(f"""
+        if log.enabled(log.DEBUG):
+            log.debug("%s", self.describeStates(where))
+        else:
+            # Only raw fields for the ring, the snapshot costs too much per call
+            log.debug("States at %s: members %#x guests %#x declared %#x tv %s absent %s installation %s",
+                      where, self.memberMask, self.guestMask, self.declaredMask,
+                      self.tv, self.absent, self.in_installation_mode)
+
+
+    def describeStates(self, where: str) -> str:
+        return f"""
 
     {where}
         Cleared audience session      : {self.cleared_aud},
@@ -407,28 +738,32 @@ class Remote(State):
         Last known key press          : {self.last_known_key_press},
         In Installation mode          : {self.in_installation_mode},
         Is remote associated          : {self.remote_paired},
+        Spooled events                : {self.pusher.spool.pending if self.pusher.spool else 'no spool'}{' (backpressure)' if self.eventBackpressure else ''},
 
         Last comm states              : Declared Viewers: {self.lastCommState.viewersDeclared}, Absent: {self.lastCommState.absent}
 
-        """)
+        """
 
 
     def is_remote_associated(self):
         if self.in_installation_mode:
-            if subprocess.getoutput(f"cat {INSTALLATION_MODE_SENTINEL}") == "with-display-remote":
+            if commands.getoutput(f"cat {INSTALLATION_MODE_SENTINEL}") == "with-display-remote":
                 return True
-        elif int(subprocess.getoutput("get_config REMOTE_ID")) == int(subprocess.getoutput("meter_id")) :
+        elif int(commands.getoutput("get_config REMOTE_ID")) == int(commands.getoutput("meter_id")) :
             return True
-        elif int(subprocess.getoutput("get_config REMOTE_ID")) == int(subprocess.getoutput("meter_id")) + 10000000 :
+        elif int(commands.getoutput("get_config REMOTE_ID")) == int(commands.getoutput("meter_id")) + 10000000 :
             return True
 
         return False
 
     def getTvStatus(self):
+        tv_status = self.boardValue(status_board.TV_STATUS)
+        if tv_status is not None:
+            return bool(tv_status)
         if which("derived_tv_status") is not None:
-            tv_status = subprocess.getoutput('derived_tv_status')
+            tv_status = commands.getoutput('derived_tv_status')
         else:
-            tv_status = subprocess.getoutput('tv_status')
+            tv_status = commands.getoutput('tv_status')
         return bool(int(tv_status))
 
 
@@ -446,6 +781,19 @@ class DisplayHandler(Remote):
         fails, and retried indefinitely.
         """
         super().__init__()
+        self.topRow = bytearray(b"."*MEMBER_COUNT)
+        self.bottomRow = bytearray(b"."*(GUEST_COUNT+1))
+        self.lastFrame = None
+        self.memberConfigWatch = self.watchMemberConfig()
+        self.metrics = MetricsWriter()
+        self.loopIterations = 0
+        self.keysHandled = {}
+        self.framesSent = {}
+        self.frameBytes = {}
+        self.lastMetricsAt = None
+        self.lastMetricsIterations = 0
+        self.watchdog = LoopWatchdog(lambda: self.describeStates("Stalled"))
+        self.memoryTracer = MemoryTracer()
         while True:
             if self.connect():
                 break
@@ -459,7 +807,7 @@ class DisplayHandler(Remote):
             self.dspi = dsp.init()
             if not self.dspi:
                 if not notified:
-                    dprint("Vayve LCD Display not detected")
+                    log.debug("Vayve LCD Display not detected")
                     notified = True
                 time.sleep(10)
             else:
@@ -476,24 +824,24 @@ class DisplayHandler(Remote):
                         count+=1
                 self.displayOnTime = None
                 break
-            if (self.is_remote_associated() and self.getTvStatus()) and self.viewersRegistered and not self.viewersDeclared:
+            if (self.is_remote_associated() and self.getTvStatus()) and self.memberMask and not self.declaredMask:
                 self.buzz()
-        dprint(f"Clearing display")
-        self.dspi.Clear()
+        log.debug("Clearing display")
+        self.clearDisplay()
         return True
 
     def close(self):
-        dprint("Closing port ...")
+        log.debug("Closing port ...")
         self.dspi.Close()
         self.dspi = None
 
 
     def buzz(self):
         if not self.is_remote_associated():
-            dprint("No remote associated, Ignoring beep")
+            log.debug("No remote associated, Ignoring beep")
             return
         try:
-            subprocess.run("buzz 4 &", shell=True)
+            commands.run("buzz 4 &", shell=True)
         except Exception as e:
             print(f"Got exception while execing beep")
 
@@ -539,45 +887,132 @@ class DisplayHandler(Remote):
         self.lastRemoteCmd['cmd'] = cmd
 
         if cmd in self.NumToKey:
-            return self.NumToKey[cmd]
+            key = self.NumToKey[cmd]
+            self.keyScreenPending = self.keyEventPending = (key, time.monotonic())
+            return key
         else:
             return None
 
 
+    def watchMemberConfig(self):
+        """
+        Watches the file backing `MEMBER_INFO`, if one is configured
+        """
+        if not MEMBER_CONFIG_PATH:
+            return None
+        try:
+            return FileWatch(MEMBER_CONFIG_PATH)
+        except OSError as e:
+            print(f"Not watching member config: {e}")
+            return None
+
+
+    def reloadMemberConfig(self):
+        """
+        Applies a `MEMBER_INFO` edit in place. Declarations of members that
+        were removed are dropped and reported with the next event.
+        """
+        old = self.memberMask
+        self.viewersRegistered = self.readMemberConfig()
+        added = self.memberMask & ~old
+        removed = old & ~self.memberMask
+        if not (added or removed):
+            return
+        print(f"Member config changed, added: {maskToViewers(added)}, removed: {maskToViewers(removed)}")
+        if self.declaredMask & removed:
+            self.declaredMask &= ~removed
+            if not self.stateChangedAt:
+                self.stateChangedAt = datetime.datetime.now()
+        if self.remote_paired:
+            self.display()
+
+
+    def buildViewershipRows(self):
+        """
+        Fills the row buffers from the viewer masks
+        """
+        top, bottom = self.topRow, self.bottomRow
+        registered = self.registeredMask
+        declared = self.declaredMask
+        for i in range(MEMBER_COUNT):
+            bit = 1 << i
+            if not registered & bit:
+                top[i] = ROW_UNREGISTERED
+            elif declared & bit:
+                top[i] = ROW_LABELS[i]
+            else:
+                top[i] = ROW_UNDECLARED
+        for i in range(MEMBER_COUNT, MEMBER_COUNT+GUEST_COUNT):
+            bit = 1 << i
+            if not registered & bit:
+                bottom[i-MEMBER_COUNT] = ROW_UNREGISTERED
+            elif declared & bit:
+                bottom[i-MEMBER_COUNT] = ROW_LABELS[i]
+            else:
+                bottom[i-MEMBER_COUNT] = ROW_UNDECLARED
+        bottom[GUEST_COUNT] = ROW_ABSENT if self.absent else ROW_PRESENT
+
+
+    @property
+    def displayModel(self) -> str:
+        return f"{self.dspi.vid:04x}:{self.dspi.pid:04x}"
+
+
+    def frameWritten(self, start: float, size: int, model: str = None):
+        """
+        Records a panel write of `size` bytes that started at `start` and,
+        for the first write after a key press, the key-to-screen time.
+        """
+        done = time.monotonic()
+        model = model or self.displayModel
+        self.latency.record("serial_write", model, done - start)
+        self.framesSent[model] = self.framesSent.get(model, 0) + 1
+        self.frameBytes[model] = self.frameBytes.get(model, 0) + size
+        if self.keyScreenPending is not None:
+            key, at = self.keyScreenPending
+            self.latency.record("key_to_screen", key, done - at)
+            self.keyScreenPending = None
+
+
+    @traced("Send")
+    def sendFrame(self, mode="viewership") -> bool:
+        """
+        Pushes the row buffers to the panel unless the same
+        `(top, bottom, mode, brightness)` frame is already on screen.
+        """
+        last = self.lastFrame
+        if last is not None and last[0] == self.topRow and last[1] == self.bottomRow \
+                and last[2] == mode and last[3] == self.brightnessLevel:
+            return False
+        start = time.monotonic()
+        self.dspi.SetBrightness(self.brightnessLevel)
+        self.dspi.Send(self.topRow.decode(), self.bottomRow.decode())
+        self.frameWritten(start, len(self.topRow) + len(self.bottomRow))
+        self.lastFrame = (bytes(self.topRow), bytes(self.bottomRow), mode, self.brightnessLevel)
+        return True
+
+
+    def clearDisplay(self):
+        self.dspi.Clear()
+        self.lastFrame = None
+
+
+    @traced("display")
     def display(self, info=False, autorefresh=False):
         """
         This func prepares the info needed to be
         displayed based on the `:ref: State` data structure.
         """
+        start = time.monotonic()
         #if info and self.dspi.pid == 0x7523:
         #    self.dspi.showInfo(self.gsm_status, self.getTvStatus(), self.wm_status)
-        
+
         if info and self.dspi.pid != 0x7523:
-            top_row = ["WMK:"+str(int(self.wm_status))+"  "+"GSM:"+str(int(self.gsm_status))]
-            bottom_row = ["L:"+str(int(self.uploader_status))+"  "]
-            if self.getTvStatus():
-                bottom_row.append("o")
-            else:
-                bottom_row.append("f")
+            self.topRow[:] = f"WMK:{int(self.wm_status)}  GSM:{int(self.gsm_status)}".encode()
+            self.bottomRow[:] = f"L:{int(self.uploader_status)}  {'o' if self.getTvStatus() else 'f'}".encode()
         elif self.grKeyPressTime is None:
-            top_row = []
-            bottom_row = []
-            for i in range(65, 77):
-                c = chr(i)
-                if c in self.viewersRegistered and c not in self.viewersDeclared:
-                    c = "_"
-                elif c not in self.viewersRegistered:
-                    c = "."
-                top_row.append(c)
-            for i in range(1, 6):
-                c = str(i)
-                if self.guest_reg(Guest(c)) and "G"+c not in self.viewersDeclared:
-                    c = "_"
-                elif not self.guest_reg(Guest(c)):
-                    c = "."
-                bottom_row.append(c)
-            bottom_row.append(str(int(self.absent)))
-            
+            self.buildViewershipRows()
+
             if info and self.dspi.pid == 0x7523:
                 if self.infoFlag == False:
                     self.dspi.showInfo(self.gsm_status, self.getTvStatus(), self.wm_status)
@@ -585,25 +1020,31 @@ class DisplayHandler(Remote):
                 elif self.infoFlag == True:
                     self.dspi.showInfo()
                     self.infoFlag = False
+                # showInfo lights the panel behind sendFrame's back
+                self.lastFrame = None
         else:
             if self.guestFlowKeys == self.guestRegState2:
-                top_row = ["REG GUEST   "]
-                bottom_row = [str(i) if self.guest_reg(Guest(i)) else "*" for i in range(1, 6)]
+                self.topRow[:] = b"REG GUEST   "
+                guests = self.guestMask >> MEMBER_COUNT
+                for i in range(GUEST_COUNT):
+                    self.bottomRow[i] = ROW_LABELS[MEMBER_COUNT+i] if guests >> i & 1 else ROW_FREE_SLOT
             elif self.guestFlowKeys == self.guestRegState3:
                 group = self.toBeRegisteredGuest.identity
                 if group is None:
                     group = "  "
-                top_row = [f"A: {self.AgeGroup[group[1:]]}"+f"   {group[0]}"]
-                bottom_row = [str(i) if str(i) == self.toBeRegisteredGuest.position else " " for i in range(1, 6)]
-            bottom_row.append(";")
-        self.dspi.SetBrightness(self.brightnessLevel)
-        self.dspi.Send("".join(top_row), "".join(bottom_row))
+                self.topRow[:] = f"A: {self.AgeGroup[group[1:]]}   {group[0]}".encode()
+                position = int(self.toBeRegisteredGuest.position)-1
+                for i in range(GUEST_COUNT):
+                    self.bottomRow[i] = ROW_LABELS[MEMBER_COUNT+i] if i == position else ROW_BLANK
+            self.bottomRow[GUEST_COUNT] = ROW_GUEST_FLOW
+        self.sendFrame()
         if not autorefresh:
             self.displayOnTime = datetime.datetime.now()
         if not info:
             # To disable the refreshInfo routine.
             if self.last_known_key_press == "INFO":
                 self.last_known_key_press = None
+        self.latency.record("display", self.displayModel, time.monotonic() - start)
 
 
     def displayTimeout(self, force=False):
@@ -612,7 +1053,7 @@ class DisplayHandler(Remote):
         """
         if force or (self.displayOnTime and datetime.datetime.now() - self.displayOnTime > datetime.timedelta(seconds=DISPLAY_TIMEOUT)):
             if not self.tv:
-                self.dspi.Clear()
+                self.clearDisplay()
             self.displayOnTime = None
             self.last_known_key_press = None
 
@@ -634,7 +1075,7 @@ class DisplayHandler(Remote):
         guest registration based on the key press.
         """
         if key in self.guestRegState2:
-            self.toBeRegisteredGuest=self.guest_reg(Guest(key[1:]))
+            self.toBeRegisteredGuest=self.guestsRegistered.get(key[1:])
             if not self.toBeRegisteredGuest:
                 self.toBeRegisteredGuest=Guest(key[1:])
             self.guestFlowKeys = self.guestRegState3
@@ -644,14 +1085,12 @@ class DisplayHandler(Remote):
                 self.toBeRegisteredGuest.identity = key
                 done = False
             else:
-                if not self.guest_reg(self.toBeRegisteredGuest):
-                    self.guestsRegistered.append(self.toBeRegisteredGuest)
-                if "G"+self.toBeRegisteredGuest.position not in self.viewersDeclared:
-                    self.viewersDeclared.append("G"+self.toBeRegisteredGuest.position)
-                    self.viewersDeclared.sort()
-                self.pushEvent(self.toBeRegisteredGuest)
-                # Since the `saveState` will clear the timer
-                self.pushEvent()
+                self.guestsRegistered.add(self.toBeRegisteredGuest)
+                self.declaredMask |= guestBit(self.toBeRegisteredGuest.position)
+                with self.pusher.batch():
+                    self.pushEvent(self.toBeRegisteredGuest)
+                    # Since the `saveState` will clear the timer
+                    self.pushEvent()
                 self.saveState()
                 self.clearGRFlow()
                 done = True
@@ -666,6 +1105,7 @@ class DisplayHandler(Remote):
         """
         count=0
         while True:
+            self.watchdog.beat()
 
             if datetime.datetime.now() - self.grKeyPressTime > datetime.timedelta(seconds=GREG_KP_TIMEOUT):
                 self.clearGRFlow()
@@ -685,6 +1125,8 @@ class DisplayHandler(Remote):
                     elif self.guestFlowKeys == self.guestRegState3:
                         self.dspi.lightChar("A")
                         self.dspi.clearChar("A")
+                    # The blink bypasses sendFrame, the next frame must be sent again
+                    self.lastFrame = None
 
             try:
                 key = self.detectKeypress(self.dspi)
@@ -702,7 +1144,7 @@ class DisplayHandler(Remote):
                 return
 
             self.dprintStates("In guest flow ..")
-            print(f"New Key press received for key: {key}")
+            log.info("New Key press received for key: %s", key)
             if key not in self.guestFlowKeys:
                 continue
 
@@ -720,7 +1162,7 @@ class DisplayHandler(Remote):
         """
         self.guestFlowKeys = self.guestRegState2
         self.grKeyPressTime = datetime.datetime.now()
-        self.dspi.Clear()
+        self.clearDisplay()
         self.display()
         self.guestKeyPress()
 
@@ -733,48 +1175,59 @@ class DisplayHandler(Remote):
         Effect: `stateChangedAt` is only considered in these
         cases
         """
-        if key in self.guestRegState2 and not self.guest_reg(Guest(key[1:])):
+        if key in self.guestRegState2 and not self.guestMask & VIEWER_BITS[key]:
             self.grKeyPressTime = datetime.datetime.now()
-            self.dspi.Clear()
+            self.clearDisplay()
             self.handleRegistration(key)
             self.guestKeyPress()
             return
-        if key in self.viewers and (key in self.viewersRegistered or self.guest_reg(Guest(key[1:]))):
-            if key in self.viewersDeclared:
-                self.viewersDeclared.remove(key)
-            else:
-                self.viewersDeclared.append(key)
-            self.viewersDeclared.sort()
+        bit = VIEWER_BITS.get(key, 0)
+        if bit & self.registeredMask:
+            self.declaredMask ^= bit
             self.display()
             if not self.stateChangedAt:
                 self.stateChangedAt = datetime.datetime.now()
 
 
     def handleInfo(self, autorefresh=False):
-        try:
-            scores = subprocess.getoutput("cat /run/wm_scores")
-            self.wm_status = sum(list(map(int, scores.split(" ")))) >= 2
-        except Exception as e:
-            dprint(f"Got exception while querying for wm scores")
-
-        try:
-            self.gsm_status = any(s in subprocess.getoutput('cat /run/SIM_"$(cat /run/current-sim)"_status') for s in ["Spotty", "OK"])
-        except Exception as e:
-            dprint(f"Got exception while querying for sim 1 status")
+        wm_status = self.boardValue(status_board.WM_STATUS)
+        if wm_status is not None:
+            self.wm_status = bool(wm_status)
+        else:
+            try:
+                scores = commands.getoutput("cat /run/wm_scores")
+                self.wm_status = sum(list(map(int, scores.split(" ")))) >= 2
+            except Exception as e:
+                log.debug("Got exception while querying for wm scores")
+
+        gsm_status = self.boardValue(status_board.GSM_STATUS)
+        if gsm_status is not None:
+            self.gsm_status = bool(gsm_status)
+        else:
+            try:
+                self.gsm_status = any(s in commands.getoutput('cat /run/SIM_"$(cat /run/current-sim)"_status', name="sim_status") for s in ["Spotty", "OK"])
+            except Exception as e:
+                log.debug("Got exception while querying for sim 1 status")
 
-        try:
-            self.uploader_status = Path("/run/uploader_connected").is_file()
-        except Exception as e:
-            dprint(f"Got exception while querying for uploader status")
+        uploader_status = self.boardValue(status_board.UPLOADER_STATUS)
+        if uploader_status is not None:
+            self.uploader_status = bool(uploader_status)
+        else:
+            try:
+                self.uploader_status = Path("/run/uploader_connected").is_file()
+            except Exception as e:
+                log.debug("Got exception while querying for uploader status")
 
         self.display(info=True, autorefresh=autorefresh)
         self.refreshed_info_at = datetime.datetime.now()
 
 
+    @traced("handleKey")
     def handleKey(self, key):
         """
         Remote key press handler
         """
+        start = time.monotonic()
         if key in self.viewers:
             self.handleDeclaration(key)
         elif key in self.guestRegState1:
@@ -801,6 +1254,72 @@ class DisplayHandler(Remote):
             if self.displayOnTime is not None:
                 self.displayTimeout(force=True)
         self.last_known_key_press = key
+        self.keysHandled[key] = self.keysHandled.get(key, 0) + 1
+        self.latency.record("handle_key", key, time.monotonic() - start)
+
+
+    def writeMetrics(self):
+        """
+        Writes the counters and current state to the node_exporter textfile
+        """
+        m = self.metrics
+        now = time.monotonic()
+        if self.lastMetricsAt is not None:
+            rate = (self.loopIterations - self.lastMetricsIterations) / (now - self.lastMetricsAt)
+            m.metric("loop_iterations_per_second", "gauge", "run() loop iterations per second since the last write", rate)
+        self.lastMetricsAt = now
+        self.lastMetricsIterations = self.loopIterations
+        m.metric("loop_iterations_total", "counter", "run() loop iterations", self.loopIterations)
+        m.metric("loop_overruns_total", "counter", "run() loop iterations over the watchdog budget", self.watchdog.overruns)
+        m.metric("loop_max_stall_seconds", "gauge", "Longest run() loop iteration over the watchdog budget", self.watchdog.max_stall)
+        m.metric("memory_rss_bytes", "gauge", "Resident set size of the handler", rssBytes())
+        m.family("keys_total", "counter", "Remote keys handled")
+        for key, n in sorted(self.keysHandled.items()):
+            m.sample("keys_total", n, {"key": key})
+        m.family("frames_total", "counter", "Frames written to a display")
+        for model, n in sorted(self.framesSent.items()):
+            m.sample("frames_total", n, {"display": model})
+        m.family("frame_bytes_total", "counter", "Bytes handed to the display drivers")
+        for model, n in sorted(self.frameBytes.items()):
+            m.sample("frame_bytes_total", n, {"display": model})
+        m.histograms("latency_seconds", "Handler latencies, see latency_stats.py",
+                     (({"metric": metric, "label": label}, h) for (metric, label), h in sorted(self.latency.histograms.items())))
+        self.writeStats.rollover()
+        m.metric("db_field_writes_total", "counter", "Fields saveState passed to DBInterface.saveState", self.writeStats.writes_total)
+        m.metric("db_bytes_written_total", "counter", "Payload bytes of the fields saveState wrote", self.writeStats.bytes_total)
+        m.metric("db_commits_total", "counter", "DB connections saveState wrote to, one commit each at most", self.writeStats.commits_total)
+        m.metric("db_bytes_written_today", "gauge", "Payload bytes saveState wrote since midnight", self.writeStats.bytes)
+        m.metric("db_commits_today", "gauge", "Commits of saveState since midnight", self.writeStats.commits)
+        m.metric("events_sent_total", "counter", "Events delivered to PUSH_ADDR", self.pusher.sent)
+        m.metric("event_send_failures_total", "counter", "Failed event sends", self.pusher.failures)
+        m.metric("event_reconnects_total", "counter", "Reconnects to PUSH_ADDR", self.pusher.reconnects)
+        spool = self.pusher.spool
+        m.metric("events_spooled", "gauge", "Events waiting in the spool", spool.pending if spool else 0)
+        m.metric("events_dropped_total", "counter", "Events dropped by the full spool or for want of one",
+                 self.pusher.dropped + (spool.dropped if spool else 0))
+        m.metric("dbus_signals_total", "counter", "StateChange signals sent", self.notifier.sent)
+        m.metric("dbus_reconnects_total", "counter", "Reconnects to D-Bus", self.notifier.reconnects)
+        spawns = sorted(commands.commands.stats.items())
+        m.family("spawns_total", "counter", "External commands spawned")
+        for name, c in spawns:
+            m.sample("spawns_total", c.count, {"command": name})
+        m.family("spawn_seconds_total", "counter", "Wall time spent in external commands")
+        for name, c in spawns:
+            m.sample("spawn_seconds_total", c.total, {"command": name})
+        m.family("spawn_max_seconds", "gauge", "Longest run of an external command")
+        for name, c in spawns:
+            m.sample("spawn_max_seconds", c.max, {"command": name})
+        m.family("spawn_exits_total", "counter", "External command exit statuses")
+        for name, c in spawns:
+            for status, n in c.statuses.items():
+                m.sample("spawn_exits_total", n, {"command": name, "status": status})
+        m.metric("tv_on", "gauge", "TV is on", bool(self.tv))
+        m.metric("absent", "gauge", "Household marked absent", bool(self.absent))
+        m.metric("installation_mode", "gauge", "Meter is in installation mode", bool(self.in_installation_mode))
+        m.metric("remote_paired", "gauge", "Remote is paired", bool(self.remote_paired))
+        m.metric("event_backpressure", "gauge", "Event spool is above its high watermark", self.eventBackpressure)
+        m.metric("viewers_declared", "gauge", "Declared members and guests", bin(self.declaredMask).count("1"))
+        m.write()
 
 
     def refreshInfo(self):
@@ -817,6 +1336,18 @@ class DisplayHandler(Remote):
         """
         Remote key press detection routine
         """
+        self.watchdog.start()
+        if self.warmStarted:
+            # Paint the snapshotted state before going to the slow sources
+            self.display()
+            if self.validateSnapshot():
+                # Replace what the snapshot put on screen
+                self.lastFrame = None
+                self.display()
+
+        # Deliver whatever the previous run could not before anything new
+        self.pusher.retry(force=True)
+
         if not self.tv:
             self.onTVOFF()
 
@@ -834,9 +1365,25 @@ class DisplayHandler(Remote):
             self.onNewAud(datetime.datetime.now().strftime(f"%Y-%m-%d {AUDIENCE_SESSION_CLOSE_TIME}"))
         self.dprintStates("main")
         self.display()
+        iteration = None
         while True:
+            iteration = tracer.lap("run", iteration)
+            self.watchdog.beat()
+            self.pusher.retry()
+            if self.latency.dump_requested:
+                self.latency.dump(display=self.displayModel if self.dspi else None, events_sent=self.pusher.sent)
+                log.dump()
+            if tracer.export_requested:
+                tracer.export()
+            self.memoryTracer.poll()
+            self.loopIterations += 1
+            if self.metrics.due():
+                self.writeMetrics()
             self.checkEventGen()
 
+            if self.memberConfigWatch is not None and self.memberConfigWatch.changed():
+                self.reloadMemberConfig()
+
             tv_status = self.getTvStatus()
             remote_paired_status = self.is_remote_associated()
 
@@ -873,7 +1420,7 @@ class DisplayHandler(Remote):
             if inNewAud():
                 self.onNewAud(datetime.datetime.now().strftime(f"%Y-%m-%d {AUDIENCE_SESSION_CLOSE_TIME}"))
 
-            if (self.remote_paired and self.tv) and self.viewersRegistered and not self.viewersDeclared:
+            if (self.remote_paired and self.tv) and self.memberMask and not self.declaredMask:
                 # This will give sometime for user-input
                 if not self.displayOnTime:
                     self.display()
@@ -890,7 +1437,7 @@ class DisplayHandler(Remote):
                 time.sleep(0.1)
                 continue
 
-            print(f"New Key press received for key: {key}")
+            log.info("New Key press received for key: %s", key)
 
             if key in self.validKeys:
                 self.handleKey(key)
@@ -899,15 +1446,26 @@ class DisplayHandler(Remote):
 
 
 def main():
-    global AUDIENCE_SESSION_CLOSE_TIME, VERBOSE
+    global AUDIENCE_SESSION_CLOSE_TIME
     AUDIENCE_SESSION_CLOSE_TIME =  os.environ["AUDIENCE_SESSION_CLOSE_TIME"]
     if AUDIENCE_SESSION_CLOSE_TIME is None:
         raise RuntimeError("Couldn't find AUDIENCE_SESSION_CLOSE_TIME env")
     # Assuming that the value is always in UTC.
     AUDIENCE_SESSION_CLOSE_TIME = (datetime.datetime.strptime(AUDIENCE_SESSION_CLOSE_TIME, "%H:%M:%S") + datetime.timedelta(hours=5, minutes=30)).strftime("%H:%M:%S")
-    VERBOSE = bool(int(os.environ["VERBOSE"]))
+    if int(os.environ["VERBOSE"]):
+        log.setLevel(log.DEBUG)
+    if handler_trace.RECORD_PATH:
+        handler_trace.record(sys.modules[__name__])
     dsh = DisplayHandler()
-    dsh.run()
+    signal.signal(signal.SIGUSR1, dsh.latency.requestDump)
+    if tracer.enabled:
+        signal.signal(signal.SIGUSR2, tracer.requestExport)
+    signal.signal(signal.SIGRTMIN + 1, dsh.memoryTracer.requestToggle)
+    try:
+        dsh.run()
+    except Exception:
+        log.error("Display handler crashed:\n%s", traceback.format_exc())
+        raise
 
 
 if __name__ == "__main__":
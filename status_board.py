@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+"""
+Fixed layout, memory mapped status board for meter health signals.
+
+Producers publish the signals the display handler needs (watermark, GSM,
+uploader, TV and installation mode) into one small file in `/run`. Readers
+map it once and read it lock-free: a sequence counter is bumped to an odd
+value before and back to even after every write, and a reader retries
+when the counter is odd or changed underneath it.
+
+Each field has a bit in `valid` that is set once a producer has written
+it, so readers can fall back to their old sources for the rest. Every
+field also carries the CLOCK_MONOTONIC time of its last update, and a
+field not updated for `STATUS_BOARD_MAX_AGE` seconds reads as unpublished
+too, so the value of a producer that died is not trusted forever.
+Producers republish their fields well within that bound; 0 disables it.
+
+Shell producers can update fields with
+    status_board.py tv_status=1 wm_status=0
+and `status_board.py --publish` runs as the producer of all five fields:
+it reads them from the sources the handler would otherwise query itself
+and republishes them every `STATUS_BOARD_PUBLISH_INTERVAL` seconds. A
+field whose source fails is not republished and ages out, so readers fall
+back to querying it.
+"""
+
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import time
+
+BOARD_PATH = os.environ.get("STATUS_BOARD_PATH", "/run/status_board")
+BOARD_VERSION = 2
+BOARD_RETRIES = 100
+BOARD_MAX_AGE = float(os.environ.get("STATUS_BOARD_MAX_AGE", 300))
+PUBLISH_INTERVAL = float(os.environ.get("STATUS_BOARD_PUBLISH_INTERVAL", 2))
+INSTALLATION_MODE_SENTINEL = "/run/installation_mode"
+
+# seq | version | valid | wm | gsm | uploader | tv | installation | updated_at per field
+BOARD = struct.Struct("<IHHBBBBB3x5d")
+SEQ = struct.Struct("<I")
+
+WM_STATUS = 0
+GSM_STATUS = 1
+UPLOADER_STATUS = 2
+TV_STATUS = 3
+INSTALLATION_MODE = 4
+FIELDS = {
+    "wm_status": WM_STATUS,
+    "gsm_status": GSM_STATUS,
+    "uploader_status": UPLOADER_STATUS,
+    "tv_status": TV_STATUS,
+    "installation_mode": INSTALLATION_MODE,
+}
+
+
+class StatusBoard():
+    """
+    Read-only view of the status board
+    """
+
+    def __init__(self, fd):
+        self.mm = mmap.mmap(fd, BOARD.size, prot=mmap.PROT_READ)
+        os.close(fd)
+
+
+    @classmethod
+    def open(cls, path: str = BOARD_PATH):
+        """
+        Maps the board at `path`, `None` if no producer has created it yet
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        if os.fstat(fd).st_size < BOARD.size:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+
+    def read(self):
+        """
+        Returns a consistent `(valid, wm, gsm, uploader, tv, installation,
+        updated_at * 5)` tuple, `None` if a writer kept it busy.
+        """
+        mm = self.mm
+        for _ in range(BOARD_RETRIES):
+            seq = SEQ.unpack_from(mm)[0]
+            if seq & 1:
+                continue
+            fields = BOARD.unpack_from(mm)
+            if SEQ.unpack_from(mm)[0] == seq and fields[1] == BOARD_VERSION:
+                return fields[2:]
+        return None
+
+
+    def get(self, field: int, max_age: float = BOARD_MAX_AGE):
+        """
+        Returns the value of `field`, `None` if it has not been published
+        or not within the last `max_age` seconds
+        """
+        fields = self.read()
+        if fields is None or not fields[0] & (1 << field):
+            return None
+        if max_age > 0 and time.monotonic() - fields[6+field] > max_age:
+            return None
+        return fields[1+field]
+
+
+    def close(self):
+        self.mm.close()
+
+
+class StatusBoardWriter():
+
+    def __init__(self, path: str = BOARD_PATH):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < BOARD.size:
+            os.ftruncate(self.fd, BOARD.size)
+        self.mm = mmap.mmap(self.fd, BOARD.size)
+
+
+    def update(self, **values):
+        """
+        Publishes the given fields, e.g. `update(tv_status=1)`
+        """
+        # Serialises writers across processes, readers never take it
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            fields = list(BOARD.unpack_from(self.mm))
+            seq = fields[0]
+            if seq & 1:
+                # A writer died half way through
+                seq += 1
+            if fields[1] != BOARD_VERSION:
+                # Left by an older layout, start over
+                fields = [seq, BOARD_VERSION, 0] + [0] * 5 + [0.0] * 5
+            valid = fields[2]
+            now = time.monotonic()
+            for name, value in values.items():
+                field = FIELDS[name]
+                fields[3+field] = int(value)
+                fields[8+field] = now
+                valid |= 1 << field
+            SEQ.pack_into(self.mm, 0, seq+1)
+            BOARD.pack_into(self.mm, 0, seq+1, BOARD_VERSION, valid, *fields[3:])
+            SEQ.pack_into(self.mm, 0, seq+2)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+def readFile(path: str) -> str:
+    with open(path) as f:
+        return f.read().strip()
+
+
+def wmStatus() -> bool:
+    return sum(map(int, readFile("/run/wm_scores").split())) >= 2
+
+
+def gsmStatus() -> bool:
+    status = readFile(f"/run/SIM_{readFile('/run/current-sim')}_status")
+    return any(s in status for s in ("Spotty", "OK"))
+
+
+def uploaderStatus() -> bool:
+    return os.path.isfile("/run/uploader_connected")
+
+
+def tvStatus() -> bool:
+    cmd = "derived_tv_status" if shutil.which("derived_tv_status") is not None else "tv_status"
+    return bool(int(subprocess.run([cmd], capture_output=True, text=True, timeout=5, check=True).stdout))
+
+
+def installationMode() -> bool:
+    return os.path.exists(INSTALLATION_MODE_SENTINEL)
+
+
+SOURCES = {
+    "wm_status": wmStatus,
+    "gsm_status": gsmStatus,
+    "uploader_status": uploaderStatus,
+    "tv_status": tvStatus,
+    "installation_mode": installationMode,
+}
+
+
+def publish(writer: StatusBoardWriter, interval: float = PUBLISH_INTERVAL):
+    """
+    Republishes every field from its source each `interval` seconds
+    """
+    failing = set()
+    while True:
+        values = {}
+        for name, source in SOURCES.items():
+            try:
+                values[name] = int(source())
+            except (OSError, ValueError, subprocess.SubprocessError) as e:
+                if name not in failing:
+                    print(f"Not publishing {name}: {e}")
+                    failing.add(name)
+                continue
+            failing.discard(name)
+        if values:
+            writer.update(**values)
+        time.sleep(interval)
+
+
+def main():
+    if sys.argv[1:] == ["--publish"]:
+        publish(StatusBoardWriter())
+    values = {}
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition("=")
+        if name not in FIELDS or not value:
+            print(f"Usage: {sys.argv[0]} --publish | <{'|'.join(FIELDS)}>=<0|1> ...")
+            exit(-1)
+        values[name] = int(value)
+    writer = StatusBoardWriter()
+    writer.update(**values)
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
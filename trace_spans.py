@@ -0,0 +1,144 @@
+"""
+Opt-in span recorder producing Chrome trace-event JSON.
+
+Set `DISPLAY_HANDLER_TRACE=1` to record begin/end spans into a ring of the
+last `DISPLAY_HANDLER_TRACE_EVENTS` spans. The handler writes them to
+`DISPLAY_HANDLER_TRACE_PATH` on SIGUSR2 and at exit; load the file in
+chrome://tracing or https://ui.perfetto.dev.
+
+With tracing off, `traced` returns the function undecorated and `tracer`
+is a no-op, so nothing is paid on the hot paths.
+"""
+
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+TRACE_ENABLED = os.environ.get("DISPLAY_HANDLER_TRACE", "0") not in ("", "0")
+TRACE_PATH = os.environ.get("DISPLAY_HANDLER_TRACE_PATH", "/run/display-handler.trace.json")
+TRACE_EVENTS = int(os.environ.get("DISPLAY_HANDLER_TRACE_EVENTS", 20000))
+
+
+class Tracer():
+
+    enabled = True
+
+    def __init__(self, capacity: int = TRACE_EVENTS, path: str = TRACE_PATH):
+        self.events = collections.deque(maxlen=capacity)
+        self.path = path
+        self.pid = os.getpid()
+        self.export_requested = False
+
+
+    def complete(self, name: str, start: float, end: float, cat: str = "handler", args=None):
+        """
+        Records a span from `start` to `end`, both `time.monotonic()` values
+        """
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": self.pid,
+            "tid": threading.get_native_id(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str = "handler", **args):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.monotonic(), cat, args)
+
+
+    def lap(self, name: str, started_at):
+        """
+        Closes the span opened by the previous `lap` and opens the next one,
+        for loops whose iterations have several exits.
+        """
+        now = time.monotonic()
+        if started_at is not None:
+            self.complete(name, started_at, now)
+        return now
+
+
+    def requestExport(self, *args):
+        """
+        Signal handler, the export itself is done by the main loop
+        """
+        self.export_requested = True
+
+
+    def export(self, path: str = None):
+        self.export_requested = False
+        path = path or self.path
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"traceEvents": list(self.events), "displayTimeUnit": "ms"}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not write trace to {path}: {e}")
+            return
+        print(f"Wrote {len(self.events)} trace spans to {path}")
+
+
+class NullTracer():
+
+    enabled = False
+    export_requested = False
+
+    def complete(self, name, start, end, cat="handler", args=None):
+        pass
+
+
+    def span(self, name, cat="handler", **args):
+        return contextlib.nullcontext()
+
+
+    def lap(self, name, started_at):
+        return None
+
+
+    def requestExport(self, *args):
+        pass
+
+
+    def export(self, path=None):
+        pass
+
+
+tracer = Tracer() if TRACE_ENABLED else NullTracer()
+if TRACE_ENABLED:
+    atexit.register(tracer.export)
+
+
+def traced(name: str, cat: str = "handler"):
+    """
+    Decorator recording a span for every call of the function
+    """
+    def decorate(func):
+        if not tracer.enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.complete(name, start, time.monotonic(), cat)
+        return wrapper
+    return decorate
+